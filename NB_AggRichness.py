@@ -5,24 +5,38 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingAlgorithm,
                        QgsProcessingMultiStepFeedback,
                        QgsProcessingParameterVectorLayer,
-                       QgsProcessingUtils,
                        QgsProcessingParameterField,
                        QgsProcessingParameterVectorDestination,
                        QgsVectorDataProvider,
                        QgsField,
-                       QgsExpression,
-                       QgsExpressionContext,
-                       QgsExpressionContextUtils,
-                       QgsVectorLayer,
                        QgsProcessingParameterBoolean,
-                       QgsVectorFileWriter,
-                       QgsSpatialIndex,
-                       QgsProcessingException,
-                       edit)
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterNumber,
+                       QgsProcessingParameterFile,
+                       QgsFeatureRequest,
+                       QgsProcessingException)
 from qgis import processing
+import math
 import os
-import numpy as np
-from datetime import datetime
+import sys
+import time
+
+scriptFolder = os.path.dirname(os.path.abspath(__file__))
+if scriptFolder not in sys.path:
+    sys.path.append(scriptFolder)
+
+from NB_modules import (ScratchStore,
+                        AttributeWriter,
+                        attributeRequest,
+                        writeAreaField,
+                        processPool,
+                        chunkList,
+                        runChunks,
+                        ogrSource,
+                        sourceStamp)
+from NB_workers import aggregateUnits
+from NB_checkpoint import RunManifest, fingerprint
+from NB_metrics import DIVERSITY_FIELDS, diversityMetrics, factorize
 
 class calcRichness(QgsProcessingAlgorithm):
 
@@ -30,6 +44,10 @@ class calcRichness(QgsProcessingAlgorithm):
     AGG_FIELD = 'AGG_FIELD'
     AGG_GRID = 'AGG_GRID'
     COVERAGE_OPTION = 'COVERAGE_OPTION'
+    METHOD = 'METHOD'
+    WORKERS = 'WORKERS'
+    CHECKPOINT_FOLDER = 'CHECKPOINT_FOLDER'
+    RESUME = 'RESUME'
     OUTPUT = 'RICH_GRID'
 
     def tr(self, string):
@@ -87,6 +105,39 @@ class calcRichness(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterEnum(
+            self.METHOD,
+            self.tr('Aggregation method'),
+            options=[self.tr('Clip data to each aggregation unit'), self.tr('Single overlay of aggregation units and data')],
+            defaultValue=0,
+            optional=True)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+            self.WORKERS,
+            self.tr('Number of worker processes (clip method only)'),
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=1,
+            minValue=1)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFile(
+            self.CHECKPOINT_FOLDER,
+            self.tr('Folder for checkpoints of the run, kept until the run is complete (clip method only)'),
+            behavior=QgsProcessingParameterFile.Folder,
+            optional=True)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+            self.RESUME,
+            self.tr('Resume from the checkpoints of an earlier run with the same inputs'),
+            defaultValue=False)
+        )
+
         self.addParameter(
             QgsProcessingParameterVectorDestination(
             self.OUTPUT,
@@ -100,18 +151,14 @@ class calcRichness(QgsProcessingAlgorithm):
         AGG_FIELD = self.parameterAsString(parameters, self.AGG_FIELD, context)
         AGG_GRID = self.parameterAsVectorLayer(parameters, self.AGG_GRID, context)
         COVERAGE_OPTION = self.parameterAsBool(parameters, self.COVERAGE_OPTION, context)
+        METHOD = self.parameterAsEnum(parameters, self.METHOD, context)
+        WORKERS = self.parameterAsInt(parameters, self.WORKERS, context)
+        CHECKPOINT_FOLDER = self.parameterAsFile(parameters, self.CHECKPOINT_FOLDER, context)
+        RESUME = self.parameterAsBool(parameters, self.RESUME, context)
         RICH_GRID = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
         
-        # Intermediate files
-        tempFolder = os.path.join(QgsProcessingUtils.tempFolder(), 'aggregation')
-        if not os.path.exists(tempFolder):
-            os.mkdir(tempFolder)
-        
-        sam = os.path.join(tempFolder, 'sam.shp')
-        gridInitial = os.path.join(tempFolder, 'gridInitial.shp')
-        gridMask = os.path.join(tempFolder, 'gridMask.shp')
-
-        vectorOverlap = os.path.join(tempFolder, 'vectorOverlap.shp')
+        # Intermediate layers
+        store = ScratchStore(context)
 
         feedback = QgsProcessingMultiStepFeedback(2, model_feedback)
         results = {}
@@ -137,7 +184,7 @@ class calcRichness(QgsProcessingAlgorithm):
         alg_params = {
             'INPUT': AGG_DATA,
             'FIELD': [],
-            'OUTPUT': sam
+            'OUTPUT': store.destination('sam', 1)
         }
 
         outputs['samDissolve'] = processing.run(
@@ -153,10 +200,12 @@ class calcRichness(QgsProcessingAlgorithm):
         if COVERAGE_OPTION == True:
             model_feedback.pushInfo('Considering units only fully within the mask')
 
+            sam = store.layer('sam', outputs['samDissolve']['OUTPUT'])
+
             alg_params = {
                 'INPUT': AGG_GRID,
                 'LAYERS': [sam],
-                'OUTPUT': gridInitial
+                'OUTPUT': store.destination('gridInitial', AGG_GRID.featureCount())
             }
 
             outputs['overlap'] = processing.run(
@@ -166,8 +215,8 @@ class calcRichness(QgsProcessingAlgorithm):
             )
             
             # Go through feature class and select only those with 100%
-            percentField = 'sam_pc'
-            maskFC = QgsVectorLayer(gridInitial)
+            maskFC = store.layer('gridInitial', outputs['overlap']['OUTPUT'])
+            percentField = [field.name() for field in maskFC.fields() if field.name().endswith('_pc')][-1]
             caps = maskFC.dataProvider().capabilities()
             feats = maskFC.getFeatures()
             dfeats = []
@@ -183,11 +232,9 @@ class calcRichness(QgsProcessingAlgorithm):
         else:
             model_feedback.pushInfo('Considering all aggregation units')
 
-            writer = QgsVectorFileWriter.writeAsVectorFormat(AGG_GRID, gridInitial, 'utf-8', driverName='ESRI Shapefile')
-            del(writer)
+            maskFC = store.copy(AGG_GRID, 'gridInitial')
 
         # Check the number of features in the new mask
-        maskFC = QgsVectorLayer(gridInitial)
         maskFeatures = maskFC.featureCount()
 
         # If number of features == 0, throw error
@@ -217,182 +264,190 @@ class calcRichness(QgsProcessingAlgorithm):
             res = maskFC.dataProvider().addAttributes([QgsField('area_km2', QVariant.Double)])
             maskFC.updateFields()
 
-        expContext = QgsExpressionContext()
-        expContext.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(maskFC))
-        exp1 = QgsExpression('area($geometry) / 1000000')
+        writeAreaField(maskFC, 'area_km2', 1000000)
 
-        with edit(maskFC):
-            for f in maskFC.getFeatures():
-                expContext.setFeature(f)
-                f['area_km2'] = exp1.evaluate(expContext)
-                maskFC.updateFeature(f)
-
-        # Initialise some variables
+        # Clipped pieces of the data in each unit as (class, area) keyed by feature ID
         unitNo = 0
-        numCovers = []
-        shannonIndex = []
-        inverseSimpsonsIndex =[]
-        meanPatchAreas = []
-
-        # Loop through each unit/square
-        
-        # Make folder to hold individual shapefiles
-        timeNow = datetime.now()
-        folderName = timeNow.strftime('%Y%m%d_%H%M%S')
-        unitFolder = os.path.join(tempFolder, folderName)
-        os.mkdir(unitFolder)
-
-        for f in maskFC.getFeatures():
-            unitNo += 1
-            
-            model_feedback.pushInfo("Aggregating data from unit " + str(unitNo) + " of " + str(maskFeatures))
-            
-            # Export as individual square
-            featureID = f.id()
-            featureSHP = 'unit' + str(featureID) + '.shp'
-            featureFN = os.path.join(unitFolder, featureSHP)
-            maskFC.select([featureID])
-            writer = QgsVectorFileWriter.writeAsVectorFormat(maskFC, featureFN, 'utf-8', driverName='ESRI Shapefile', onlySelected=True)
-            del(writer)
-            maskFC.removeSelection()
-            
-            index = QgsSpatialIndex()
-            index.insertFeature(f)
-
-            unitFC = QgsVectorLayer()
-            unitSize = f['area_km2']
-
-            dataSHP = 'data' + str(featureID) + '.shp'
-            dataFN = os.path.join(unitFolder, dataSHP)
+        unitPieces = {}
+
+        # Units clipped so far are kept in the checkpoint folder, a later run on the same inputs skips them
+        # The scratch copy of the units gets the same feature IDs in every run
+        manifest = None
+        newPieces = {}
+        checkpointTime = time.time()
+        checkpointInterval = 300
+
+        if CHECKPOINT_FOLDER != '' and METHOD == 0:
+            runFingerprint = fingerprint({
+                'data': sourceStamp(AGG_DATA),
+                'field': AGG_FIELD,
+                'units': sourceStamp(AGG_GRID),
+                'coverage': COVERAGE_OPTION
+            })
+            manifest = RunManifest(CHECKPOINT_FOLDER, self.name(), runFingerprint, RESUME)
+
+            for key in manifest.keys():
+                for featureID, pieces in manifest.data(key):
+                    unitPieces[featureID] = [tuple(piece) for piece in pieces]
+
+            unitNo = len(unitPieces)
+            if unitNo > 0:
+                model_feedback.pushInfo('Resuming with ' + str(unitNo) + ' units aggregated before')
+
+        def saveCheckpoint(force=False):
+            # Record the units clipped since the last checkpoint as a new part
+            nonlocal newPieces, checkpointTime
+            if manifest is None or len(newPieces) == 0:
+                return
+            if not force and time.time() - checkpointTime < checkpointInterval:
+                return
+
+            manifest.record('units ' + str(len(manifest.keys())), data=list(newPieces.items()))
+            newPieces = {}
+            checkpointTime = time.time()
+
+        if METHOD == 1:
+            model_feedback.pushInfo('Overlaying aggregation units with the data to aggregate...')
+
+            # Tag each unit with its feature ID so the overlay pieces can be grouped
+            caps = maskFC.dataProvider().capabilities()
+            if caps & QgsVectorDataProvider.AddAttributes:
+                res = maskFC.dataProvider().addAttributes([QgsField('NB_UNIT', QVariant.Int)])
+                maskFC.updateFields()
 
-            # Clip the aggregation data to the single unit
+            with AttributeWriter(maskFC, ['NB_UNIT']) as writer:
+                for f in maskFC.getFeatures(attributeRequest(maskFC, [])):
+                    writer.write(f.id(), [f.id()])
+
+            # The overlay pieces are measured in the CRS of the data, so it has to be the CRS of the units
+            # as in the clip method, where features are reprojected on the fly
+            overlayData = AGG_DATA
+            if AGG_DATA.crs() != samCRS:
+                model_feedback.pushInfo('Reprojecting the data to aggregate to the coordinate system of the units...')
+                alg_params = {
+                    'INPUT': AGG_DATA,
+                    'TARGET_CRS': samCRS,
+                    'OUTPUT': store.destination('dataProj', AGG_DATA.featureCount())
+                }
+
+                outputs['projected'] = processing.run(
+                    'native:reprojectlayer',
+                    alg_params, context=context,
+                    feedback=feedback, is_child_algorithm=True
+                )
+
+                overlayData = store.reference('dataProj', store.layer('dataProj', outputs['projected']['OUTPUT']))
+
+            # Intersect the whole grid with the data once
             alg_params = {
-                'INPUT': AGG_DATA,
-                'OVERLAY': featureFN,
-                'OUTPUT': dataFN
+                'INPUT': overlayData,
+                'OVERLAY': maskFC,
+                'INPUT_FIELDS': [AGG_FIELD],
+                'OVERLAY_FIELDS': ['NB_UNIT'],
+                'OUTPUT': store.destination('overlayData', AGG_DATA.featureCount() + maskFeatures)
             }
 
-            clipID = 'clip' + str(featureID)
-            outputs[clipID] = processing.run(
-                'native:clip',
+            outputs['overlay'] = processing.run(
+                'native:intersection',
                 alg_params, context=context,
                 feedback=feedback, is_child_algorithm=True
             )
-            
-            # index.insertFeature(QgsVectorLayer(dataFN))
 
             feedback.setCurrentStep(2)
             if feedback.isCanceled():
                 return {}
 
-            ##################
-            ### Patch area ###
-            ##################
-
-            # Calculate the area in hectares for patch area
-            dataClip = QgsVectorLayer(dataFN)
-            fields = [field.name() for field in dataClip.fields()]
-
-            caps = dataClip.dataProvider().capabilities()
-            if caps & QgsVectorDataProvider.AddAttributes:
-                if 'area_ha' in fields:
-                    idx = fields.index('area_ha')
-                    res = dataClip.dataProvider().deleteAttributes([idx])
-
-                res = dataClip.dataProvider().addAttributes([QgsField('area_ha', QVariant.Double)])
-                dataClip.updateFields()
-
-            expContext = QgsExpressionContext()
-            expContext.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(dataClip))
-            exp1 = QgsExpression('area($geometry) / 10000')
-
-            patchAreas = []
+            # Group the pieces by unit
+            overlayFC = store.layer('overlayData', outputs['overlay']['OUTPUT'])
+            for feat in overlayFC.getFeatures():
+                area = feat.geometry().area()
+                unitPieces.setdefault(feat['NB_UNIT'], []).append((feat[AGG_FIELD], area))
 
-            with edit(dataClip):
-                for feat in dataClip.getFeatures():
-                    expContext.setFeature(feat)
-                    feat['area_ha'] = exp1.evaluate(expContext)
-                    patchAreas.append(float(feat['area_ha']))
-                    dataClip.updateFeature(feat)
-
-            if len(patchAreas) == 0:
-                meanPatchArea = 0
+        else:
+            if WORKERS > 1:
+                model_feedback.pushInfo('Aggregating units in ' + str(WORKERS) + ' worker processes...')
             else:
-                meanPatchArea = np.mean(patchAreas)
+                model_feedback.pushInfo('Aggregating units...')
+
+            # The data is read with OGR, in the CRS of the aggregation units, whatever the number of workers
+            # Each unit is clipped whole by aggregateUnits, so neither the chunks nor the workers change the results
+            dataSource, dataLayer = ogrSource(AGG_DATA, samCRS, store, 'dataCopy', context, feedback)
+
+            units = [(f.id(), bytes(f.geometry().asWkb())) for f in maskFC.getFeatures(QgsFeatureRequest().setNoAttributes())
+                     if f.id() not in unitPieces]
+
+            # Without workers smaller chunks report progress and save checkpoints more often
+            chunkSize = max(1, math.ceil(len(units) / (WORKERS * 4)))
+            if WORKERS <= 1:
+                chunkSize = min(chunkSize, 100)
+
+            pool = processPool(WORKERS) if WORKERS > 1 else None
+            skipped = 0
+            try:
+                for unitResults, unitSkipped in runChunks(pool, aggregateUnits, chunkList(units, chunkSize),
+                                                          dataSource, dataLayer, AGG_FIELD):
+                    for featureID, pieces in unitResults:
+                        unitPieces[featureID] = pieces
+                        newPieces[featureID] = pieces
+                        unitNo += 1
+                    skipped += unitSkipped
+
+                    model_feedback.pushInfo("Aggregated data from " + str(unitNo) + " of " + str(maskFeatures) + " units")
+
+                    saveCheckpoint(feedback.isCanceled())
+                    if feedback.isCanceled():
+                        return {}
+            finally:
+                if pool is not None:
+                    pool.shutdown(wait=True, cancel_futures=True)
 
-            meanPatchAreas.append(meanPatchArea)
+            feedback.setCurrentStep(2)
 
-            ##########################
-            ### Other metrics area ###
-            ##########################
+            # Invalid geometries are repaired first, pieces that still fail are left out of the metrics
+            if skipped > 0:
+                model_feedback.reportError(str(skipped) + ' pieces with geometries that could not be repaired or intersected '
+                                           'were left out of the aggregation', False)
 
-            dissolveSHP = 'dissolve' + str(featureID) + '.shp'
-            dissolveFN = os.path.join(unitFolder, dissolveSHP)
+        # All units are clipped, keep the last ones until the output is written
+        saveCheckpoint(True)
 
-            # Dissolved clipped area and calculate area in km2
-            alg_params = {
-                'INPUT': dataClip,
-                'FIELD':[AGG_FIELD],
-                'OUTPUT': dissolveFN
-            }
+        # Flatten the pieces into one (unit, class, area) table
+        unitIDs = []
+        unitSizes = []
+        pieceUnits = []
+        pieceClasses = []
+        pieceAreas = []
 
-            dissolveID = 'dissolve' + str(featureID)
-            outputs[dissolveID] = processing.run(
-                'native:dissolve',
-                alg_params, context=context,
-                feedback=feedback, is_child_algorithm=True
-            )
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes(['area_km2'], maskFC.fields())
 
-            # Calculate the area in km2 for each LC
-            dissolveFC = QgsVectorLayer(dissolveFN)
-            fields = [field.name() for field in dissolveFC.fields()]
+        for f in maskFC.getFeatures(request):
+            unitIndex = len(unitIDs)
+            unitIDs.append(f.id())
+            unitSizes.append(float(f['area_km2']) * 1000000)
 
-            caps = dissolveFC.dataProvider().capabilities()
-            if caps & QgsVectorDataProvider.AddAttributes:
-                if 'area_km2' in fields:
-                    idx = fields.index('area_km2')
-                    res = dissolveFC.dataProvider().deleteAttributes([idx])
-
-                res = dissolveFC.dataProvider().addAttributes([QgsField('area_km2', QVariant.Double)])
-                dissolveFC.updateFields()
-
-            expContext = QgsExpressionContext()
-            expContext.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(dissolveFC))
-            exp2 = QgsExpression('area($geometry) / 1000000')
-
-            classificationsCount = 0
-            probOcc = []
-
-            with edit(dissolveFC):
-                for feat in dissolveFC.getFeatures():
-                    expContext.setFeature(feat)
-                    feat['area_km2'] = exp2.evaluate(expContext)
-                    classificationsCount += 1
-                    probOcc.append(float(feat['area_km2']) / float(unitSize))
-                    dissolveFC.updateFeature(feat)
-
-            if len(probOcc) == 0:
-                shannon = -1
-                inverseSimpsons = -1
-            else:
-                shannon = -sum(probOcc * np.log(probOcc))
-                inverseSimpsons = 1 / sum(np.array(probOcc) * np.array(probOcc))
+            for lcClass, area in unitPieces.get(f.id(), []):
+                pieceUnits.append(unitIndex)
+                pieceClasses.append(lcClass)
+                pieceAreas.append(area)
+
+        # Calculate the metrics of all units in one go
+        classCodes, classes = factorize(pieceClasses)
+        metrics = diversityMetrics(pieceUnits, classCodes, pieceAreas, unitSizes)
+        unitRows = dict(zip(unitIDs, range(len(unitIDs))))
 
-            shannonIndex.append(shannon)
-            inverseSimpsonsIndex.append(inverseSimpsons)
-            numCovers.append(classificationsCount)
-        
         fields = [field.name() for field in maskFC.fields()]
-        fieldsToRemove = ['NUM_COVERS', 'SHANNON', 'INVSIMPSON', 'MEANPATCH']
+        intFields = ['NUM_COVERS', 'NUM_PATCH']
 
-        caps = dataClip.dataProvider().capabilities()
+        caps = maskFC.dataProvider().capabilities()
         if caps & QgsVectorDataProvider.AddAttributes:
-            for field in fieldsToRemove:
+            for field in DIVERSITY_FIELDS:
                 if field in fields:
-                    idx = fields.index(field)
+                    idx = maskFC.fields().indexOf(field)
                     res = maskFC.dataProvider().deleteAttributes([idx])
+                    maskFC.updateFields()
 
-                if field == 'NUM_COVERS':
+                if field in intFields:
                     res = maskFC.dataProvider().addAttributes([QgsField(field, QVariant.Int)])
                     maskFC.updateFields()
 
@@ -400,15 +455,18 @@ class calcRichness(QgsProcessingAlgorithm):
                     res = maskFC.dataProvider().addAttributes([QgsField(field, QVariant.Double)])
                     maskFC.updateFields()
 
-        
-        with edit(maskFC):
-            for f in maskFC.getFeatures():
-                featureID = f.id()
-                f['NUM_COVERS'] = numCovers[featureID]
-                f['SHANNON'] = float(shannonIndex[featureID])
-                f['INVSIMPSON'] = float(inverseSimpsonsIndex[featureID])
-                f['MEANPATCH'] = float(meanPatchAreas[featureID])
-                maskFC.updateFeature(f)
+        # Write the metrics as plain Python values
+        columns = [metrics[field].tolist() for field in DIVERSITY_FIELDS]
+
+        with AttributeWriter(maskFC, DIVERSITY_FIELDS) as writer:
+            for featureID, row in unitRows.items():
+                writer.write(featureID, [column[row] for column in columns])
+
+        # Drop the unit ID used to group the overlay
+        if 'NB_UNIT' in fields:
+            if caps & QgsVectorDataProvider.DeleteAttributes:
+                res = maskFC.dataProvider().deleteAttributes([maskFC.fields().indexOf('NB_UNIT')])
+                maskFC.updateFields()
 
         alg_params = {
             'INPUT': maskFC,
@@ -425,6 +483,10 @@ class calcRichness(QgsProcessingAlgorithm):
         if feedback.isCanceled():
             return {}
 
+        # The output is written, the checkpoints of the run are not needed any more
+        if manifest is not None:
+            manifest.clear()
+
         #writer = QgsVectorFileWriter.writeAsVectorFormat(maskFC, RICH_GRID, 'utf-8', driverName='ESRI Shapefile')
         #del(writer)
 
@@ -4,34 +4,69 @@ Nature Braid for SEEA
 IUCN Red List Processing Tool
 '''
 
-from qgis.PyQt.QtCore import (QCoreApplication, QVariant)
+from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (QgsProcessing,
                        QgsProcessingException,
                        QgsProcessingAlgorithm,
                        QgsProcessingMultiStepFeedback,
                        QgsProcessingParameterVectorLayer,
-                       QgsProcessingUtils,
                        QgsProcessingParameterNumber,
                        QgsProcessingParameterRasterDestination,
-                       QgsVectorFileWriter,
-                       QgsVectorLayer,
-                       QgsVectorDataProvider,
-                       QgsField,
-                       QgsRasterLayer,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterFile,
+                       QgsProcessingParameterFileDestination,
+                       QgsProcessingParameterField,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterString,
+                       NULL,
                        QgsProcessingFeatureSourceDefinition,
                        QgsFeatureRequest,
-                       edit
+                       QgsFeatureSource,
+                       QgsVectorDataProvider,
+                       QgsReferencedRectangle,
+                       QgsRectangle,
+                       QgsProcessingOutputMultipleLayers
                        )
-from qgis.analysis import QgsRasterCalculator, QgsRasterCalculatorEntry
 from qgis import processing
+from osgeo import gdal
+import math
 import os
-from datetime import datetime
+import sys
+import time
+import numpy as np
+
+scriptFolder = os.path.dirname(os.path.abspath(__file__))
+if scriptFolder not in sys.path:
+    sys.path.append(scriptFolder)
+
+from NB_modules import ScratchStore, chunkList, processPool, runChunks, rangeAreas, rowAreas, sourceStamp, speciesKeys
+from NB_rasterise import RasterGrid, RasterWriter, SpeciesBurner, countType, speciesIndex, tileSize
+from NB_workers import openLayer, rasteriseSpecies
+from NB_cache import RangeCache
+from NB_presence import PresenceMatrix, tilePixels, packParts, unpackParts
+from NB_checkpoint import RunManifest, fingerprint
 
 class calcIUCNRichness(QgsProcessingAlgorithm):
     INPUT = 'IUCN_SHP'
     SAM = 'SAM'
+    GROUP_FIELD = 'GROUP_FIELD'
     OUTPUT_RES = 'OUTPUT_RES'
+    SIMPLIFY = 'SIMPLIFY'
+    BURN_MODE = 'BURN_MODE'
+    COVERAGE_THRESHOLD = 'COVERAGE_THRESHOLD'
+    PYRAMID = 'PYRAMID'
+    CHECKPOINT_FOLDER = 'CHECKPOINT_FOLDER'
+    RESUME = 'RESUME'
+    MEMORY_BUDGET = 'MEMORY_BUDGET'
+    BUILD_INDEX = 'BUILD_INDEX'
+    WORKERS = 'WORKERS'
+    CACHE_FOLDER = 'CACHE_FOLDER'
+    CACHE_LIMIT = 'CACHE_LIMIT'
     OUTPUT = 'RICH_RAS'
+    PRESENCE = 'PRESENCE'
+    RARITY = 'RARITY_RAS'
+    ENDEMISM = 'ENDEMISM_RAS'
+    PYRAMID_OUTPUTS = 'PYRAMID_OUTPUTS'
 
     def tr(self, string):
         return QCoreApplication.translate('Processing', string)
@@ -72,6 +107,16 @@ class calcIUCNRichness(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterField(
+            self.GROUP_FIELD,
+            self.tr('Grouping field, one richness band per group after the total band'),
+            '',
+            self.INPUT,
+            optional=True
+            )
+        )
+
         self.addParameter(
             QgsProcessingParameterNumber(
             self.OUTPUT_RES,
@@ -80,52 +125,219 @@ class calcIUCNRichness(QgsProcessingAlgorithm):
             defaultValue=0.005)
         )
 
+        self.addParameter(
+            QgsProcessingParameterNumber(
+            self.SIMPLIFY,
+            self.tr('Simplify ranges to this fraction of a pixel before burning (0 keeps full detail)'),
+            type=QgsProcessingParameterNumber.Double,
+            defaultValue=0.0,
+            minValue=0.0,
+            maxValue=0.5)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterEnum(
+            self.BURN_MODE,
+            self.tr('Species count in a pixel'),
+            options=[self.tr('When the pixel centre is in the range'), self.tr('By the fraction of the pixel covered by the range')],
+            defaultValue=0)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+            self.COVERAGE_THRESHOLD,
+            self.tr('Covered fraction for a species to count in a pixel (0 adds up the fractions)'),
+            type=QgsProcessingParameterNumber.Double,
+            defaultValue=0.0,
+            minValue=0.0,
+            maxValue=1.0)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterString(
+            self.PYRAMID,
+            self.tr('Coarser richness rasters, as whole multiples of the output resolution (e.g. 5,10)'),
+            defaultValue='',
+            optional=True)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+            self.MEMORY_BUDGET,
+            self.tr('Memory budget for the rasters (MB), larger grids are processed in tiles'),
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=2048,
+            minValue=16)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+            self.BUILD_INDEX,
+            self.tr('Build a spatial index for the IUCN dataset if it has none (kept for later runs)'),
+            defaultValue=False)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+            self.WORKERS,
+            self.tr('Number of worker processes for rasterizing species'),
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=1,
+            minValue=1)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFile(
+            self.CACHE_FOLDER,
+            self.tr('Folder for the cache of rasterized species ranges, reused by later runs'),
+            behavior=QgsProcessingParameterFile.Folder,
+            optional=True)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+            self.CACHE_LIMIT,
+            self.tr('Size limit of the cache (MB), least recently used ranges are removed first'),
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=10240,
+            minValue=0)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFile(
+            self.CHECKPOINT_FOLDER,
+            self.tr('Folder for checkpoints of the run, kept until the run is complete'),
+            behavior=QgsProcessingParameterFile.Folder,
+            optional=True)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+            self.RESUME,
+            self.tr('Resume from the checkpoints of an earlier run with the same inputs'),
+            defaultValue=False)
+        )
+
         self.addParameter(
             QgsProcessingParameterRasterDestination(
             self.OUTPUT,
             self.tr('Richness raster')
             )
         )
+
+        self.addParameter(
+            QgsProcessingParameterFileDestination(
+            self.PRESENCE,
+            self.tr('Species presence matrix, for the richness of species subsets'),
+            fileFilter='NumPy archive (*.npz)',
+            optional=True,
+            createByDefault=False)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(
+            self.RARITY,
+            self.tr('Range-size rarity raster, sum of 1 / range area (km2) of the species'),
+            optional=True,
+            createByDefault=False)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(
+            self.ENDEMISM,
+            self.tr('Weighted endemism raster, sum of the share of each species range in the pixel'),
+            optional=True,
+            createByDefault=False)
+        )
+
+        self.addOutput(
+            QgsProcessingOutputMultipleLayers(
+            self.PYRAMID_OUTPUTS,
+            self.tr('Coarser richness rasters, written next to the richness raster'))
+        )
         
         
     def processAlgorithm(self, parameters, context, model_feedback):
         # Final inputs and outputs
         IUCN_SHP = self.parameterAsVectorLayer(parameters, self.INPUT, context)
         SAM = self.parameterAsVectorLayer(parameters, self.SAM, context)
+        GROUP_FIELD = self.parameterAsString(parameters, self.GROUP_FIELD, context)
         OUTPUT_RES = self.parameterAsDouble(parameters, self.OUTPUT_RES, context)
+        SIMPLIFY = self.parameterAsDouble(parameters, self.SIMPLIFY, context)
+        BURN_MODE = self.parameterAsEnum(parameters, self.BURN_MODE, context)
+        COVERAGE_THRESHOLD = self.parameterAsDouble(parameters, self.COVERAGE_THRESHOLD, context)
+        PYRAMID = self.parameterAsString(parameters, self.PYRAMID, context)
+        MEMORY_BUDGET = self.parameterAsInt(parameters, self.MEMORY_BUDGET, context)
+        BUILD_INDEX = self.parameterAsBool(parameters, self.BUILD_INDEX, context)
+        WORKERS = self.parameterAsInt(parameters, self.WORKERS, context)
+        CACHE_FOLDER = self.parameterAsFile(parameters, self.CACHE_FOLDER, context)
+        CACHE_LIMIT = self.parameterAsInt(parameters, self.CACHE_LIMIT, context)
+        CHECKPOINT_FOLDER = self.parameterAsFile(parameters, self.CHECKPOINT_FOLDER, context)
+        RESUME = self.parameterAsBool(parameters, self.RESUME, context)
         RICH_RAS = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)        
+        PRESENCE = self.parameterAsFileOutput(parameters, self.PRESENCE, context)
+        RARITY_RAS = self.parameterAsOutputLayer(parameters, self.RARITY, context)
+        ENDEMISM_RAS = self.parameterAsOutputLayer(parameters, self.ENDEMISM, context)
         
-        # Temporary files
-        timeNow = datetime.now()
-        folderName = timeNow.strftime('%Y%m%d_%H%M%S')        
-        tempFolder = os.path.join(QgsProcessingUtils.tempFolder(), folderName)
-        if not os.path.exists(tempFolder):
-            os.mkdir(tempFolder)
-
-        sam_proj = os.path.join(tempFolder, 'sam.shp')
-        sam_ras = os.path.join(tempFolder, 'sam_ras.tif')
-        iucn_clipped = os.path.join(tempFolder, 'iucn_clipped.shp')
-        addition_ras = os.path.join(tempFolder, 'addition_ras.tif')
-
-        feedback = QgsProcessingMultiStepFeedback(2, model_feedback)
+        # Species count by the covered fraction of each pixel, or where that fraction reaches the threshold
+        coverage = BURN_MODE == 1
+        fractional = coverage and COVERAGE_THRESHOLD <= 0
+
+        # Coarser levels count each species once per coarse cell, from its presence in the fine pixels
+        # Added fractions have no presence to reduce
+        try:
+            factors = sorted(set(int(factor) for factor in PYRAMID.replace(' ', '').split(',') if factor != ''))
+        except ValueError:
+            raise QgsProcessingException('Coarser resolutions have to be whole numbers separated by commas')
+
+        factors = [factor for factor in factors if factor > 1]
+        if len(factors) > 0 and fractional:
+            model_feedback.pushInfo('Coarser levels need presence, they are not built when fractions are added')
+            factors = []
+
+        # Rasterized ranges are cached when a cache folder is given
+        # The cache holds presence only, so added fractions are not cached
+        useCache = CACHE_FOLDER != '' and not fractional
+        if useCache:
+            os.makedirs(CACHE_FOLDER, exist_ok=True)
+        elif CACHE_FOLDER != '':
+            model_feedback.pushInfo('Added coverage fractions are not cached, the cache folder is not used')
+
+        # Detail below the tolerance does not change which pixel centres are in a range,
+        # except for pixels whose centre is within the tolerance of the range boundary
+        tolerance = SIMPLIFY * OUTPUT_RES
+
+        # Ranges are burnt unclipped when they are cached or simplified
+        unclipped = useCache or tolerance > 0
+
+        # Species are burnt in chunks, progress is reported after each chunk
+        speciesChunk = 50
+        idField = 'id_no'
+
+        # Seconds between checkpoints of the tile in progress
+        checkpointInterval = 300
+
+        feedback = QgsProcessingMultiStepFeedback(3, model_feedback)
         results = {}
         outputs = {}
 
+        # Intermediate layers
+        store = ScratchStore(context)
+
         # Check CRS with each other
         iucnCRS = IUCN_SHP.crs()
         samCRS = SAM.crs()
 
         if iucnCRS.authid() == samCRS.authid():
             # Same CRS, just copy over
-            writer = QgsVectorFileWriter.writeAsVectorFormat(SAM, sam_proj, 'utf-8', driverName='ESRI Shapefile')
-            del(writer)
+            samProj = store.copy(SAM, 'sam')
         else:
             model_feedback.pushInfo('Reprojecting study area mask to IUCN coordinate system...')
             # Reproject SAM to IUCN CRS
             alg_params = {
                 'INPUT': SAM,
                 'TARGET_CRS': iucnCRS,
-                'OUTPUT': sam_proj
+                'OUTPUT': store.destination('sam', SAM.featureCount())
             }
 
             outputs['projected'] = processing.run(
@@ -134,29 +346,52 @@ class calcIUCNRichness(QgsProcessingAlgorithm):
                 feedback=feedback, is_child_algorithm=True
             )
 
-        # Rasterize the study area mask
-        alg_params = {
-                'INPUT': sam_proj,
-                'BURN': 1,
-                'UNITS': 1,
-                'WIDTH': OUTPUT_RES,
-                'HEIGHT': OUTPUT_RES,
-                'EXTENT': SAM.extent(),
-                'NODATA': 0,
-                'OUTPUT': sam_ras
-            }
-
-        outputs['rasterSAM'] = processing.run(
-            'gdal:rasterize',
-            alg_params, context=context,
-            feedback=feedback, is_child_algorithm=True
-        )
+            samProj = store.layer('sam', outputs['projected']['OUTPUT'])
 
         feedback.setCurrentStep(1)
         if feedback.isCanceled():
             return {}
 
-        # Clip IUCN down (iucn_clipped)
+        # Output grid over the study area, in the IUCN coordinate system
+        # With the cache the grid lies on the lattice shared by all runs at this resolution
+        samExtent = samProj.extent()
+        if useCache:
+            grid = RasterGrid.snapped(samExtent.xMinimum(), samExtent.yMinimum(),
+                                      samExtent.xMaximum(), samExtent.yMaximum(),
+                                      OUTPUT_RES, iucnCRS.toWkt())
+            method = 'coverage>=' + repr(COVERAGE_THRESHOLD) if coverage else 'centre'
+            cache = RangeCache(CACHE_FOLDER, iucnCRS.toWkt(), OUTPUT_RES, method=method)
+        else:
+            grid = RasterGrid.fromExtent(samExtent.xMinimum(), samExtent.yMinimum(),
+                                         samExtent.xMaximum(), samExtent.yMaximum(),
+                                         OUTPUT_RES, iucnCRS.toWkt())
+            cache = None
+
+        # With the cache, candidates are all the ranges that touch the blocks of the grid
+        # so that every burnt block holds all the ranges in it, whatever the study area
+        if useCache:
+            candidateExtent = QgsRectangle(*cache.blockGrid(grid)[0].extent())
+        else:
+            candidateExtent = samExtent
+
+        # Prefilter IUCN down to the bounding box of the study area mask, or of its cache blocks (iucn_candidates)
+        # The box is pushed down to the data provider, which only reads candidates if it has a spatial index
+        indexPresence = IUCN_SHP.hasSpatialIndex()
+
+        if indexPresence == QgsFeatureSource.SpatialIndexPresent:
+            model_feedback.pushInfo('Using the spatial index of the IUCN dataset')
+
+        elif BUILD_INDEX:
+            caps = IUCN_SHP.dataProvider().capabilities()
+            if caps & QgsVectorDataProvider.CreateSpatialIndex:
+                model_feedback.pushInfo('Building spatial index of the IUCN dataset...')
+                if not IUCN_SHP.dataProvider().createSpatialIndex():
+                    model_feedback.pushWarning('Could not build a spatial index for the IUCN dataset')
+            else:
+                model_feedback.pushInfo('The IUCN dataset does not support a spatial index')
+
+        elif indexPresence == QgsFeatureSource.SpatialIndexNotPresent:
+            model_feedback.pushInfo('The IUCN dataset has no spatial index, all features will be scanned')
 
         inputFlags = QgsProcessingFeatureSourceDefinition(
             IUCN_SHP.dataProvider().dataSourceUri(),
@@ -165,270 +400,373 @@ class calcIUCNRichness(QgsProcessingAlgorithm):
             flags=QgsProcessingFeatureSourceDefinition.FlagOverrideDefaultGeometryCheck,
             geometryCheck=QgsFeatureRequest.GeometrySkipInvalid)
 
-        samFlags = QgsProcessingFeatureSourceDefinition(
-            sam_proj,
-            selectedFeaturesOnly=False,
-            featureLimit=-1,
-            flags=QgsProcessingFeatureSourceDefinition.FlagOverrideDefaultGeometryCheck,
-            geometryCheck=QgsFeatureRequest.GeometrySkipInvalid)
-
         alg_params = {
             'INPUT': inputFlags,
-            'OVERLAY': samFlags,
-            'OUTPUT': iucn_clipped
+            'EXTENT': QgsReferencedRectangle(candidateExtent, iucnCRS),
+            'CLIP': False,
+            'OUTPUT': store.destination('iucn_candidates', IUCN_SHP.featureCount(), onDisk=unclipped and tolerance <= 0)
         }
 
-        outputs['clipIUCN'] = processing.run(
-            'native:clip',
+        outputs['prefilterIUCN'] = processing.run(
+            'native:extractbyextent',
             alg_params, context=context,
             feedback=feedback, is_child_algorithm=True
         )
 
-        feedback.setCurrentStep(2)
-        if feedback.isCanceled():
-            return {}
-
-        # Add the Richness field (integer)
-        iucnFC = QgsVectorLayer(iucn_clipped)
-        fields = [field.name() for field in iucnFC.fields()]
+        candidates = store.layer('iucn_candidates', outputs['prefilterIUCN']['OUTPUT'])
+        model_feedback.pushInfo(str(candidates.featureCount()) + ' of ' + str(IUCN_SHP.featureCount()) + ' IUCN features are candidates')
 
-        caps = iucnFC.dataProvider().capabilities()
-        if caps & QgsVectorDataProvider.AddAttributes:
-            if 'Richness' in fields:
-                idx = fields.index('Richness')
-                res = iucnFC.dataProvider().deleteAttributes([idx])
-
-            res = iucnFC.dataProvider().addAttributes([QgsField('Richness', QVariant.Int)])
-            iucnFC.updateFields()
-
-        # Give Richness all a value of 1
-        with edit(iucnFC):
-            for f in iucnFC.getFeatures():
-                f['Richness'] = 1
-                iucnFC.updateFeature(f)
-
-        # Use the Split Vector Layer tool to split things up
-        speciesFolder = os.path.join(tempFolder, 'speciesLayers')
-        os.mkdir(speciesFolder)
-
-        alg_params = {
-            'INPUT': iucn_clipped,
-            'FIELD': 'id_no',
-            'FILE_TYPE': 0,
-            'OUTPUT': speciesFolder
-        }
-
-        outputs['speciesLayers'] = processing.run(
-            'native:splitvectorlayer',
-            alg_params, context=context,
-            feedback=feedback, is_child_algorithm=True
-        )
-
-        feedback.setCurrentStep(1)
         if feedback.isCanceled():
             return {}
 
-        # Rasterize each of the the layers
-
-        # Loop through each of the speciesLayers
-        speciesLyrs = os.listdir(speciesFolder)
+        # Cached ranges have to be the same whatever the study area, so they are not clipped
+        # Simplified ranges are light enough to burn whole, which is cheaper than clipping them
+        # The study area mask raster removes the pixels outside it in the same way
+        if unclipped and tolerance <= 0:
+            rangeLayer = 'iucn_candidates'
 
-        # Make the output layer
-        rasterFolder = os.path.join(tempFolder, 'rasterFolder')
-        os.mkdir(rasterFolder)
-
-        allSpecies = len(speciesLyrs)
-
-        countSpecies = 0
-        for lyr in speciesLyrs:
-            info = 'Processing species ' + str(countSpecies) + ' of ' + str(allSpecies)
-            model_feedback.pushInfo(info)
-            inFN = os.path.join(speciesFolder, lyr)
-            outID = 'raster' + str(countSpecies)
-            outName = 'ras_' + str(countSpecies) + '.tif'
-            outFN = os.path.join(rasterFolder, outName)
-            countSpecies += 1
+        elif unclipped:
+            # Simplify the candidate ranges once for the whole run (iucn_simplified)
+            # The topology preserving simplification keeps every point within the tolerance of the original boundary
+            # Every tile and group burns these, and the cache keys their blocks on the simplified ranges
+            model_feedback.pushInfo('Simplifying IUCN ranges with a tolerance of ' + str(tolerance) + '...')
+            rangeLayer = 'iucn_simplified'
 
             alg_params = {
-                'INPUT': inFN,
-                'FIELD': 'Richness',
-                'UNITS': 1,
-                'WIDTH': OUTPUT_RES,
-                'HEIGHT': OUTPUT_RES,
-                'EXTENT': SAM.extent(),
-                'NODATA': 0,
-                'OUTPUT': outFN
+                'INPUT': store.reference('iucn_candidates', candidates),
+                'METHOD': 0,
+                'TOLERANCE': tolerance,
+                'OUTPUT': store.destination(rangeLayer, candidates.featureCount(), onDisk=True)
             }
 
-            outputs[outID] = processing.run(
-                'gdal:rasterize',
+            outputs['simplifyIUCN'] = processing.run(
+                'native:simplifygeometries',
                 alg_params, context=context,
                 feedback=feedback, is_child_algorithm=True
             )
 
-            feedback.setCurrentStep(3 + countSpecies)
-            if feedback.isCanceled():
-                return {}
-
-        step = (3 + countSpecies)
-
-        # Loop through rasterised rasters
-        speciesRasters = []
-        for file in os.listdir(rasterFolder):
-            if file.endswith('.tif'):
-                speciesRasters.append(file)
-
-        # Make the output layer
-        reclassFolder = os.path.join(tempFolder, 'reclassFolder')
-        os.mkdir(reclassFolder)
+        else:
+            # Clip IUCN candidates down (iucn_clipped)
+            # Kept on disk so the ranges can be read back with OGR
+            rangeLayer = 'iucn_clipped'
 
-        totalRasters = len(speciesRasters)
-        rasterCount = 0
-        
-        for lyr in speciesRasters:
-            info = 'Processing raster ' + str(rasterCount) + ' of ' + str(totalRasters)
-            model_feedback.pushInfo(info)
-
-            inFN = os.path.join(rasterFolder, lyr)
-            outID = 'reclass' + str(rasterCount)
-            outName = 'reclass_' + str(rasterCount) + '.tif'
-            
-            outFN = os.path.join(reclassFolder, outName)
-            rasterCount += 1
-            step += 1
+            samFlags = QgsProcessingFeatureSourceDefinition(
+                store.reference('sam', samProj),
+                selectedFeaturesOnly=False,
+                featureLimit=-1,
+                flags=QgsProcessingFeatureSourceDefinition.FlagOverrideDefaultGeometryCheck,
+                geometryCheck=QgsFeatureRequest.GeometrySkipInvalid)
 
             alg_params = {
-                'INPUT': inFN,
-                'NODATA': -1,
-                'OUTPUT': outFN
+                'INPUT': store.reference('iucn_candidates', candidates),
+                'OVERLAY': samFlags,
+                'OUTPUT': store.destination(rangeLayer, candidates.featureCount(), onDisk=True)
             }
 
-            outputs[outID] = processing.run(
-                'gdal:translate',
+            outputs['clipIUCN'] = processing.run(
+                'native:clip',
                 alg_params, context=context,
                 feedback=feedback, is_child_algorithm=True
             )
 
-            feedback.setCurrentStep(step)
+        feedback.setCurrentStep(2)
+        if feedback.isCanceled():
+            return {}
+
+        # No pixel can count more species than there are candidates, which sets the output data type
+        idIdx = candidates.fields().indexOf(idField)
+        candidateSpecies = candidates.uniqueValues(idIdx)
+        countGdalType, countNumpyType = countType(len(candidateSpecies))
+
+        # Counts are added in the output type, which holds any count without wrapping
+        sumType = countNumpyType
+
+        # Added fractions are written as they are
+        if fractional:
+            countGdalType, countNumpyType = gdal.GDT_Float32, np.float32
+            sumType = countNumpyType
+
+        # Groups of the candidate ranges, the total is band 1 and each group has its own band
+        groups = []
+        if GROUP_FIELD != '':
+            fieldIdx = candidates.fields().indexOf(GROUP_FIELD)
+            groups = sorted(set(str(value) for value in candidates.uniqueValues(fieldIdx)
+                                if value is not None and value != NULL))
+            model_feedback.pushInfo(str(len(groups)) + ' groups in ' + GROUP_FIELD + ': ' + ', '.join(groups))
+
+        bands = 1 + len(groups)
+
+        # Cache keys of the candidate species, from all their features in the IUCN dataset
+        # Simplified ranges burn differently, so their blocks are kept apart for each tolerance
+        cacheKeys = {}
+        if useCache:
+            model_feedback.pushInfo('Finding the cache keys of the candidate species...')
+            cacheKeys = speciesKeys(IUCN_SHP, idField, candidateSpecies, cache, GROUP_FIELD or None, feedback)
+            if tolerance > 0:
+                cacheKeys = {speciesID: cache.simplifiedKey(key, tolerance) for speciesID, key in cacheKeys.items()}
+
             if feedback.isCanceled():
                 return {}
-        
-        # Loop through reclassified rasters
-        reclassRasters = []
-        for file in os.listdir(reclassFolder):
-            if file.endswith('.tif'):
-                fileName = os.path.join(reclassFolder, file)
-                reclassRasters.append(fileName)
-
-        rasterIDs = []
-
-        #model_feedback.pushInfo('reclassRasters')
-        #model_feedback.pushInfo(str(reclassRasters))
-
-        layers = [QgsRasterLayer(str(raster)) for raster in reclassRasters]
-        entries = []
-
-        for i, layer in enumerate(layers, 1):
-            entry = QgsRasterCalculatorEntry()
-            entry.ref = f"layer{i}@1"
-            entry.raster = layer
-            entry.bandNumber = 1
-            entries.append(entry)
-
-        #model_feedback.pushInfo('entries')
-        #model_feedback.pushInfo(str(entries))
-        #model_feedback.pushInfo('rasterIDs')
-        #model_feedback.pushInfo(str(rasterIDs))
-
-        refs = [entry.ref for entry in entries]
-        #model_feedback.pushInfo('refs')
-        #model_feedback.pushInfo(str(refs))
-
-        operation = ''
-
-        for i in range(0, len(refs)):
-            if i in [0, len(refs)]:
-                # If it is the first or last raster
-                operation += (str(refs[i]))
-            else:
-                operation += ' + ' + str(refs[i])
 
-        #model_feedback.pushInfo('operation')
-        #model_feedback.pushInfo(str(operation))
-        
-        # Add samRaster to the raster calculator
-        samLyr = QgsRasterLayer(sam_ras)
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'sam@1'
-        ras.bandNumber = 1
-        ras.raster = samLyr
-        entries.append(ras)
-        
-        calc = QgsRasterCalculator(
-            operation,
-            addition_ras,
-            "GTiff",
-            samLyr.extent(),
-            samLyr.width(),
-            samLyr.height(),
-            entries,
-        )
-        
-        rasCalc_result = calc.processCalculation(feedback)
-        if rasCalc_result == QgsRasterCalculator.ParserError:
-            raise QgsProcessingException(self.tr("Error parsing formula"))
-        elif rasCalc_result == QgsRasterCalculator.CalculationError:
-            raise QgsProcessingException(self.tr("An error occurred while performing the calculation"))
-        
-        step += 1
-        feedback.setCurrentStep(step)
-        if feedback.isCanceled():
-            return {}
-        
-        #model_feedback.pushInfo('addition_ras')
-        #model_feedback.pushInfo(str(addition_ras))
-        
-        # Export raster where 0 is NoData values
-        entries = []
-
-        samLyr = QgsRasterLayer(sam_ras)
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'sam@1'
-        ras.bandNumber = 1
-        ras.raster = samLyr
-        entries.append(ras)
-
-        additionLyr = QgsRasterLayer(addition_ras)
-        ras = QgsRasterCalculatorEntry()
-        ras.ref = 'addition@1'
-        ras.bandNumber = 1
-        ras.raster = additionLyr
-        entries.append(ras)
-
-        # Reference: https://gis.stackexchange.com/questions/81640/how-to-set-all-pixels-with-value-0-to-nodata-in-dem-raster
-        operation = '((addition@1 > 0) * addition@1) / ((addition@1 > 0) * 1 + (addition@1 <= 0) * 0)'
-
-        calc = QgsRasterCalculator(
-            operation,
-            RICH_RAS,
-            "GTiff",
-            samLyr.extent(),
-            samLyr.width(),
-            samLyr.height(),
-            entries,
-        )
-        
-        rasCalc_result = calc.processCalculation(feedback)
-        if rasCalc_result == QgsRasterCalculator.ParserError:
-            raise QgsProcessingException(self.tr("Error parsing formula"))
-        elif rasCalc_result == QgsRasterCalculator.CalculationError:
-            raise QgsProcessingException(self.tr("An error occurred while performing the calculation"))
-        
-        step += 1
-        feedback.setCurrentStep(step)
-        if feedback.isCanceled():
-            return {}
-        
+        # Range areas of the candidate species, from all their features in the IUCN dataset
+        # Rarity and endemism are both accumulated when either is wanted, they share the range areas
+        weighted = RARITY_RAS != '' or ENDEMISM_RAS != ''
+        speciesAreas = None
+        pixelAreas = None
+
+        if weighted:
+            model_feedback.pushInfo('Measuring the range area of the candidate species...')
+            speciesAreas = rangeAreas(IUCN_SHP, idField, candidateSpecies, context, feedback)
+            pixelAreas = rowAreas(grid, iucnCRS, context)
+
+            if feedback.isCanceled():
+                return {}
+
+        # Bytes held per pixel of a tile: burn raster and buffer, mask, and richness, partial sums and output of each band
+        # Each worker holds its own burn raster, buffer and partial sums, and the parent a copy of each partial
+        # Rarity and endemism take 8 bytes for the sums and for the partial sums and 4 for the output
+        # Counts take 2 bytes per value, or 4 for more than 65535 candidate species
+        countBytes = max(2, np.dtype(countNumpyType).itemsize) if not fractional else 2
+        bytesPerPixel = 3 + 4 * countBytes * bands
+        if WORKERS > 1:
+            bytesPerPixel += WORKERS * (2 + 2 * countBytes * bands)
+        if weighted:
+            bytesPerPixel += 40 + 32 * WORKERS
+
+        # The coverage burner holds the fractions and a row accumulator, and sums of fractions take 4 bytes
+        if coverage:
+            bytesPerPixel += 20 * WORKERS
+        if fractional:
+            bytesPerPixel += 4 * bands * WORKERS
+
+        # Split the grid into tiles that fit the memory budget
+        # With coarser levels tiles are made of whole coarse cells of every level
+        size = tileSize(MEMORY_BUDGET, bytesPerPixel)
+        if len(factors) > 0:
+            cell = int(np.lcm.reduce(factors))
+            size = max(cell, size // cell * cell)
+
+        tiles = grid.tiles(size)
+
+        model_feedback.pushInfo('Output grid of ' + str(grid.width) + ' x ' + str(grid.height) + ' pixels in ' + str(len(tiles)) + ' tile(s)')
+
+        samGeometries = [bytes(f.geometry().asWkb()) for f in samProj.getFeatures(QgsFeatureRequest().setNoAttributes())]
+
+        ds, lyr = openLayer(store.gpkg, rangeLayer)
+        writer = RasterWriter(RICH_RAS, grid, 0, dataType=countGdalType, bands=bands)
+        if len(groups) > 0:
+            writer.describe(1, 'Total')
+            for k, group in enumerate(groups):
+                writer.describe(k + 2, GROUP_FIELD + ' ' + group)
+
+        weightWriters = {}
+        if RARITY_RAS != '':
+            weightWriters['rarity'] = RasterWriter(RARITY_RAS, grid, 0)
+        if ENDEMISM_RAS != '':
+            weightWriters['endemism'] = RasterWriter(ENDEMISM_RAS, grid, 0)
+
+        # Coarser levels are written next to the richness raster
+        pyramidPaths = {}
+        pyramidWriters = {}
+        for factor in factors:
+            pyramidPaths[factor] = os.path.splitext(RICH_RAS)[0] + '_x' + str(factor) + '.tif'
+            pyramidWriters[factor] = RasterWriter(pyramidPaths[factor], grid.coarsened(factor), 0, dataType=countGdalType)
+
+        # Species are shared out between the workers, each returns the partial sums of its chunk
+        # The partial sums are added here, so the result does not depend on the number of workers
+        pool = processPool(WORKERS) if WORKERS > 1 else None
+
+        # Pixels of each species within the study area, from all tiles
+        presenceParts = {}
+        keepPresence = PRESENCE != ''
+
+        # Finished tiles and the sums of the tile in progress are kept in the checkpoint folder
+        # A later run on the same inputs and settings can then carry on from there
+        manifest = None
+        if CHECKPOINT_FOLDER != '':
+            runFingerprint = fingerprint({
+                'iucn': sourceStamp(IUCN_SHP),
+                'sam': sourceStamp(SAM),
+                'grid': [grid.geoTransform(), grid.width, grid.height, grid.crsWkt, tiles],
+                'settings': [groups, tolerance, BURN_MODE, COVERAGE_THRESHOLD, factors, weighted, keepPresence]
+            })
+            manifest = RunManifest(CHECKPOINT_FOLDER, self.name(), runFingerprint, RESUME)
+            if len(manifest.keys()) > 0:
+                model_feedback.pushInfo('Resuming from ' + str(len(manifest.keys())) + ' checkpoint(s)')
+
+        try:
+            checkpointTime = time.time()
+
+            for tileNo, window in enumerate(tiles):
+                tileGrid = grid.window(*window)
+                tileKey = 'tile ' + str(tileNo)
+                partialKey = tileKey + ' partial'
+
+                # Rasterize the study area mask
+                samMask = SpeciesBurner(tileGrid).burn(samGeometries).copy()
+
+                # Burn each species range and add it into the richness array
+                richness = np.zeros((tileGrid.height, tileGrid.width), dtype=sumType)
+                groupRichness = np.zeros((len(groups), tileGrid.height, tileGrid.width), dtype=sumType)
+                weights = {'rarity': np.zeros((tileGrid.height, tileGrid.width)),
+                           'endemism': np.zeros((tileGrid.height, tileGrid.width))} if weighted else {}
+                tileAreas = pixelAreas[window[1]:window[1] + window[3]] if weighted else None
+                pyramid = {factor: np.zeros((-(-tileGrid.height // factor), -(-tileGrid.width // factor)), dtype=sumType)
+                           for factor in factors}
+                tileParts = {}
+
+                # Sums of the tile by name, as they are checkpointed
+                sums = {'richness': richness, 'groups': groupRichness}
+                sums.update(weights)
+                sums.update(('x' + str(factor), level) for factor, level in pyramid.items())
+
+                doneSpecies = set()
+                for key in (tileKey, partialKey):
+                    if manifest is not None and key in manifest:
+                        saved = manifest.arrays(key)
+                        for name, array in sums.items():
+                            np.copyto(array, saved[name])
+                        if keepPresence:
+                            tileParts = unpackParts(saved)
+                        break
+
+                if manifest is not None and tileKey in manifest:
+                    model_feedback.pushInfo('Tile ' + str(tileNo + 1) + ' of ' + str(len(tiles)) + ' was finished before')
+                    species = []
+                    allSpecies = 0
+
+                else:
+                    if manifest is not None and partialKey in manifest:
+                        doneSpecies = set(manifest.info(partialKey)['species'])
+
+                    # Only the species with ranges in the tile, or with the cache in its blocks
+                    if len(tiles) == 1:
+                        species = speciesIndex(lyr, idField)
+                    elif cache is not None:
+                        species = speciesIndex(lyr, idField, cache.blockGrid(tileGrid)[0].extent())
+                    else:
+                        species = speciesIndex(lyr, idField, tileGrid.extent())
+
+                    allSpecies = len(species)
+                    species = [(speciesID, fids, cacheKeys.get(speciesID)) for speciesID, fids in species
+                               if speciesID not in doneSpecies]
+                    model_feedback.pushInfo('Tile ' + str(tileNo + 1) + ' of ' + str(len(tiles)) + ': ' + str(allSpecies) + ' species, '
+                                            + str(len(species)) + ' left to process')
+
+                # A few chunks per worker keeps them all busy until the end of the tile
+                chunkSize = speciesChunk
+                if pool is not None:
+                    chunkSize = max(speciesChunk, math.ceil(len(species) / (WORKERS * 4)))
+
+                countSpecies = allSpecies - len(species)
+                chunks = chunkList(species, chunkSize)
+                for partial in runChunks(pool, rasteriseSpecies, chunks, store.gpkg, rangeLayer, tileGrid, cache,
+                                         presence=keepPresence, groupField=GROUP_FIELD or None, groups=groups,
+                                         rangeAreas=speciesAreas, pixelAreas=tileAreas,
+                                         coverage=coverage, threshold=COVERAGE_THRESHOLD,
+                                         factors=factors, mask=samMask if len(factors) > 0 else None):
+                    richness += partial['richness']
+                    if len(groups) > 0:
+                        groupRichness += partial['groups']
+                    for name in weights:
+                        weights[name] += partial[name]
+                    for factor in factors:
+                        pyramid[factor] += partial['pyramid'][factor]
+
+                    if keepPresence:
+                        inMask = samMask.ravel()
+                        for speciesID, pixels in partial['presence'].items():
+                            pixels = pixels[inMask[pixels] != 0]
+                            if len(pixels) > 0:
+                                tileParts.setdefault(speciesID, []).append(tilePixels(pixels, window, grid))
+
+                    doneSpecies.update(partial['speciesIDs'])
+                    countSpecies += partial['species']
+                    model_feedback.pushInfo('Processed species ' + str(countSpecies) + ' of ' + str(allSpecies))
+                    feedback.setProgress(100.0 * (tileNo + countSpecies / allSpecies) / len(tiles))
+
+                    # Save the sums so far now and then, and when the run is cancelled
+                    if manifest is not None and (feedback.isCanceled() or time.time() - checkpointTime > checkpointInterval):
+                        arrays = dict(sums)
+                        if keepPresence:
+                            arrays.update(packParts(tileParts))
+                        manifest.record(partialKey, arrays=arrays, species=sorted(doneSpecies))
+                        checkpointTime = time.time()
+
+                    if feedback.isCanceled():
+                        return {}
+
+                if manifest is not None and tileKey not in manifest:
+                    arrays = dict(sums)
+                    if keepPresence:
+                        arrays.update(packParts(tileParts))
+                    manifest.record(tileKey, arrays=arrays)
+                    manifest.discard(partialKey)
+
+                for speciesID, parts in tileParts.items():
+                    presenceParts.setdefault(speciesID, []).extend(parts)
+
+                # Export the tile where 0 is NoData values, masked by the study area
+                richness[samMask == 0] = 0
+                writer.write(richness.astype(countNumpyType), window[0], window[1])
+
+                for k in range(len(groups)):
+                    groupRichness[k][samMask == 0] = 0
+                    writer.write(groupRichness[k].astype(countNumpyType), window[0], window[1], band=k + 2)
+
+                for name, weightWriter in weightWriters.items():
+                    weights[name][samMask == 0] = 0
+                    weightWriter.write(weights[name].astype(np.float32), window[0], window[1])
+
+                # Coarse cells without species in the study area are 0 already
+                for factor, pyramidWriter in pyramidWriters.items():
+                    pyramidWriter.write(pyramid[factor].astype(countNumpyType), window[0] // factor, window[1] // factor)
+
+                feedback.setProgress(100.0 * (tileNo + 1) / len(tiles))
+
+            # Overviews for quick display at small scales
+            model_feedback.pushInfo('Building overviews...')
+            writer.buildOverviews()
+            for weightWriter in weightWriters.values():
+                weightWriter.buildOverviews('AVERAGE')
+            for pyramidWriter in pyramidWriters.values():
+                pyramidWriter.buildOverviews()
+
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+            writer.close()
+            for weightWriter in weightWriters.values():
+                weightWriter.close()
+            for pyramidWriter in pyramidWriters.values():
+                pyramidWriter.close()
+
+        del lyr
+        del ds
+
+        if keepPresence:
+            model_feedback.pushInfo('Writing the presence matrix of ' + str(len(presenceParts)) + ' species...')
+            PresenceMatrix.fromParts(presenceParts, grid).save(PRESENCE)
+            results[self.PRESENCE] = PRESENCE
+
+        # All outputs are written, the checkpoints of the run are not needed any more
+        if manifest is not None:
+            manifest.clear()
+
+        # Keep the cache within its size limit
+        if useCache:
+            removed = cache.evict(CACHE_LIMIT)
+            if removed > 0:
+                model_feedback.pushInfo('Removed ' + str(removed) + ' least recently used files from the cache')
+
+        feedback.setCurrentStep(3)
+
         results[self.OUTPUT] = RICH_RAS
+        if RARITY_RAS != '':
+            results[self.RARITY] = RARITY_RAS
+        if ENDEMISM_RAS != '':
+            results[self.ENDEMISM] = ENDEMISM_RAS
+        if len(factors) > 0:
+            results[self.PYRAMID_OUTPUTS] = [pyramidPaths[factor] for factor in factors]
         
         return results
@@ -0,0 +1,127 @@
+'''
+Nature Braid for SEEA
+
+IUCN richness of a subset of species, from a presence matrix
+'''
+
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (QgsProcessing,
+                       QgsProcessingException,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingParameterFile,
+                       QgsProcessingParameterFeatureSource,
+                       QgsProcessingParameterField,
+                       QgsProcessingParameterRasterDestination,
+                       QgsFeatureRequest,
+                       NULL
+                       )
+import os
+import sys
+
+scriptFolder = os.path.dirname(os.path.abspath(__file__))
+if scriptFolder not in sys.path:
+    sys.path.append(scriptFolder)
+
+from NB_presence import PresenceMatrix
+from NB_rasterise import RasterWriter, countType
+
+class calcIUCNSubsetRichness(QgsProcessingAlgorithm):
+    PRESENCE = 'PRESENCE'
+    SPECIES = 'SPECIES'
+    ID_FIELD = 'ID_FIELD'
+    OUTPUT = 'RICH_RAS'
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return calcIUCNSubsetRichness()
+
+    def name(self):
+        return 'calcIUCNSubsetRichness'
+
+    def displayName(self):
+        return self.tr('Calculate IUCN species richness of a subset of species')
+
+    def group(self):
+        return self.tr('Nature Braid for SEEA')
+
+    def groupId(self):
+        return 'NBScripts'
+
+    def shortHelpString(self):
+        return self.tr("Calculate IUCN species richness of the species listed in a layer or table, "
+                       "from the presence matrix written by Calculate IUCN species richness. "
+                       "Use selected features only or a filter to choose the species.")
+
+    def initAlgorithm(self, config=None):
+
+        self.addParameter(
+            QgsProcessingParameterFile(
+            self.PRESENCE,
+            self.tr('Species presence matrix'),
+            extension='npz')
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFeatureSource(
+            self.SPECIES,
+            self.tr('Species to include'),
+            types=[QgsProcessing.TypeVector]
+            )
+        )
+
+        self.addParameter(
+            QgsProcessingParameterField(
+            self.ID_FIELD,
+            self.tr('Species ID field'),
+            parentLayerParameterName=self.SPECIES,
+            defaultValue='id_no')
+        )
+
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(
+            self.OUTPUT,
+            self.tr('Richness raster')
+            )
+        )
+
+    def processAlgorithm(self, parameters, context, feedback):
+        # Final inputs and outputs
+        PRESENCE = self.parameterAsFile(parameters, self.PRESENCE, context)
+        SPECIES = self.parameterAsSource(parameters, self.SPECIES, context)
+        ID_FIELD = self.parameterAsFields(parameters, self.ID_FIELD, context)[0]
+        RICH_RAS = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)
+
+        if SPECIES is None:
+            raise QgsProcessingException(self.invalidSourceError(parameters, self.SPECIES))
+
+        matrix = PresenceMatrix.load(PRESENCE)
+
+        # Species IDs of the subset
+        request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+        request.setSubsetOfAttributes([ID_FIELD], SPECIES.fields())
+
+        speciesIDs = set()
+        for f in SPECIES.getFeatures(request):
+            value = f[ID_FIELD]
+            if value is not None and value != NULL:
+                speciesIDs.add(value)
+
+        found = len(matrix.find(speciesIDs))
+        feedback.pushInfo(str(found) + ' of ' + str(len(speciesIDs)) + ' species are in the presence matrix')
+
+        if feedback.isCanceled():
+            return {}
+
+        # Export where 0 is NoData values, as the full richness raster
+        richness = matrix.subsetRichness(speciesIDs)
+
+        gdalType, numpyType = countType(int(richness.max()) if richness.size > 0 else 0)
+
+        writer = RasterWriter(RICH_RAS, matrix.grid, 0, dataType=gdalType)
+        writer.write(richness.astype(numpyType), 0, 0)
+        writer.buildOverviews()
+        writer.close()
+
+        return {self.OUTPUT: RICH_RAS}
@@ -2,27 +2,28 @@
 
 
 
-from qgis.PyQt.QtCore import (QCoreApplication, QVariant)
+from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (QgsProcessing,
                        QgsProcessingAlgorithm,
                        QgsProcessingMultiStepFeedback,
                        QgsProcessingParameterVectorLayer,
-                       QgsProcessingUtils,
                        QgsProcessingParameterField,
                        QgsProcessingParameterVectorDestination,
-                       QgsVectorDataProvider,
-                       QgsField,
-                       QgsExpression,
-                       QgsExpressionContext,
-                       QgsExpressionContextUtils,
                        QgsVectorLayer,
+                       QgsExpression,
                        QgsProcessingParameterFileDestination,
-                       edit)
+                       QgsFeatureRequest,
+                       QgsProcessingParameterNumber)
 from qgis import processing
 import os
-import numpy as np
-import csv
-import itertools
+import sys
+
+scriptFolder = os.path.dirname(os.path.abspath(__file__))
+if scriptFolder not in sys.path:
+    sys.path.append(scriptFolder)
+
+from NB_modules import ScratchStore, writeAccounts, writeTransitionCSV, processPool, chunkList, runChunks, ogrSource
+from NB_workers import intersectTiles
 
 class CalcLandExtentCalc(QgsProcessingAlgorithm):
 
@@ -31,6 +32,8 @@ class CalcLandExtentCalc(QgsProcessingAlgorithm):
     LC_CLOSING_SHP = 'LC_CLOSING_SHP'
     LC_CLOSING = 'LC_CLOSING'
     LC_NAME = 'LC_NAME'
+    TILES = 'TILES'
+    WORKERS = 'WORKERS'
     OUTPUT_CSV = 'OUTPUT_CSV'
     OUTPUT = 'OUTPUT_LC'
 
@@ -103,6 +106,26 @@ class CalcLandExtentCalc(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterNumber(
+            self.TILES,
+            self.tr('Number of tiles along each side for the overlay (1 for a single overlay)'),
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=1,
+            minValue=1,
+            optional=True)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterNumber(
+            self.WORKERS,
+            self.tr('Number of worker processes (tiled overlay only)'),
+            type=QgsProcessingParameterNumber.Integer,
+            defaultValue=1,
+            minValue=1,
+            optional=True)
+        )
+
         self.addParameter(
             QgsProcessingParameterFileDestination(
             self.OUTPUT_CSV,
@@ -125,333 +148,132 @@ class CalcLandExtentCalc(QgsProcessingAlgorithm):
         LC_CLOSING_SHP = self.parameterAsVectorLayer(parameters, self.LC_CLOSING_SHP, context)
         LC_CLOSING = self.parameterAsString(parameters, self.LC_CLOSING, context)
         LC_NAME =  self.parameterAsString(parameters, self.LC_NAME, context)
+        TILES = self.parameterAsInt(parameters, self.TILES, context)
+        WORKERS = self.parameterAsInt(parameters, self.WORKERS, context)
         OUTPUT_CSV = self.parameterAsFileOutput(parameters, self.OUTPUT_CSV, context)
         OUTPUT_LC = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)        
         
-        # Intermediate files
-        tempFolder = os.path.join(QgsProcessingUtils.tempFolder(), 'accounts')
-        if not os.path.exists(tempFolder):
-            os.mkdir(tempFolder)
-        joinedLC = os.path.join(tempFolder, 'joinedLC.shp')
-        joinedLCCSV = os.path.join(tempFolder, 'joinedLC.csv')
-        intersectLC = os.path.join(tempFolder, 'intersectLC.shp')
-        intersectCSV = os.path.join(tempFolder, 'intersectLandCover.csv')
-
         feedback = QgsProcessingMultiStepFeedback(2, model_feedback)
         results = {}
         outputs = {}
 
-        model_feedback.pushInfo('Checking opening land cover...')
-        
-        # Clean fields of everything except code and name
-        fieldsToKeep = [str(LC_OPENING)]
+        # Intermediate layers
+        store = ScratchStore(context)
+
+        # The inputs are only read, the fields they need are picked in each request
+        openingFields = [str(LC_OPENING)]
         if str(LC_NAME) != '':
-            fieldsToKeep.append(str(LC_NAME))
-        allFields = [field.name() for field in LC_OPENING_SHP.fields()]
-        fieldsToRemove = list(set(allFields) - set(fieldsToKeep))
+            openingFields.append(str(LC_NAME))
 
-        idxRemove = []
-        for field in fieldsToRemove:
-            idx = allFields.index(field)
-            idxRemove.append(idx)
+        model_feedback.pushInfo('Calculating areas of opening and closing extents...')
+        # Area of each closing class
+        closingAreas = {}
 
-        caps = LC_OPENING_SHP.dataProvider().capabilities()
+        request = QgsFeatureRequest()
+        request.setSubsetOfAttributes([LC_CLOSING], LC_CLOSING_SHP.fields())
 
-        # Clean opening LC of everything except code and name
-        if caps & QgsVectorDataProvider.DeleteAttributes:
-            res = LC_OPENING_SHP.dataProvider().deleteAttributes(idxRemove)
-            LC_OPENING_SHP.updateFields()
+        for f in LC_CLOSING_SHP.getFeatures(request):
+            closingAreas.setdefault(f[LC_CLOSING], f.geometry().area() / 1000000)
 
-        model_feedback.pushInfo('Checking closing land cover...')
-        
-        # Clean fields except for code
-        fieldsToKeep = [str(LC_CLOSING)]
-        allFields = [field.name() for field in LC_CLOSING_SHP.fields()]
-        fieldsToRemove = list(set(allFields) - set(fieldsToKeep))
-
-        idxRemove = []
-        for field in fieldsToRemove:
-            idx = allFields.index(field)
-            idxRemove.append(idx)
-
-        caps = LC_CLOSING_SHP.dataProvider().capabilities()
-        if caps & QgsVectorDataProvider.DeleteAttributes:
-            res = LC_CLOSING_SHP.dataProvider().deleteAttributes(idxRemove)
-            LC_CLOSING_SHP.updateFields()
-
-        model_feedback.pushInfo('Intersecting opening and closing land cover...')
-        # Intersect clean LCs
+        # The output starts as the opening LC with its code and name only, classes in code order as in the matrix
         alg_params = {
             'INPUT': LC_OPENING_SHP,
-            'OVERLAY': LC_CLOSING_SHP,
-            'OUTPUT': intersectLC}
+            'EXPRESSION': QgsExpression.quotedColumnRef(LC_OPENING),
+            'ASCENDING': True,
+            'NULLS_FIRST': False,
+            'OUTPUT': store.destination('orderedLC', LC_OPENING_SHP.featureCount())
+        }
 
-        outputs['intersectLC'] = processing.run(
-            'native:intersection',
+        outputs['orderLC'] = processing.run(
+            'native:orderbyexpression',
             alg_params, context=context,
             feedback=feedback, is_child_algorithm=True)
 
-        model_feedback.pushInfo('Calculating areas of opening and closing extents...')
-        # Make a new field for area in opening LC
-        if caps & QgsVectorDataProvider.AddAttributes:
-            res = LC_OPENING_SHP.dataProvider().addAttributes([QgsField('area1_km2', QVariant.Double)])
-            LC_OPENING_SHP.updateFields()
-
-        # Calculate area for opening LC
-        expContext = QgsExpressionContext()
-        expContext.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(LC_OPENING_SHP))
-        exp1 = QgsExpression('area($geometry) / 1000000')
-        
-        with edit(LC_OPENING_SHP):
-            for f in LC_OPENING_SHP.getFeatures():
-                expContext.setFeature(f)
-                f['area1_km2'] = exp1.evaluate(expContext)
-                LC_OPENING_SHP.updateFeature(f)
-
-        # Make a new field for area for closing LC
-        if caps & QgsVectorDataProvider.AddAttributes:
-            res = LC_CLOSING_SHP.dataProvider().addAttributes([QgsField('area2_km2', QVariant.Double)])
-            LC_CLOSING_SHP.updateFields()
-
-        # Calculate area for closing LC
-        expContext = QgsExpressionContext()
-        expContext.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(LC_CLOSING_SHP))
-        exp1 = QgsExpression('area($geometry) / 1000000')
-        
-        with edit(LC_CLOSING_SHP):
-            for f in LC_CLOSING_SHP.getFeatures():
-                expContext.setFeature(f)
-                f['area2_km2'] = exp1.evaluate(expContext)
-                LC_CLOSING_SHP.updateFeature(f)
+        orderedLC = store.layer('orderedLC', outputs['orderLC']['OUTPUT'])
 
-        # Join the two land cover datasets
         alg_params = {
-            'INPUT': LC_OPENING_SHP,
-            'FIELD': LC_OPENING,
-            'INPUT_2': LC_CLOSING_SHP,
-            'FIELD_2': LC_CLOSING,
-            'FIELDS_TO_COPY':[],
-            'METHOD':1,
-            'DISCARD_NONMATCHING':False,
-            'PREFIX':'',
+            'INPUT': store.reference('orderedLC', orderedLC),
+            'FIELDS': openingFields,
             'OUTPUT': OUTPUT_LC
         }
 
-        outputs['joinLC'] = processing.run(
-            'native:joinattributestable',
+        outputs['retainLC'] = processing.run(
+            'native:retainfields',
             alg_params, context=context,
             feedback=feedback, is_child_algorithm=True)
 
-        joinedLCFile = QgsVectorLayer(OUTPUT_LC)
-
-        fields = []
-        for field in joinedLCFile.fields():
-            fields.append(str(field.name()))
-
-        caps = joinedLCFile.dataProvider().capabilities()
-
-        # Make a new field for area
-        if caps & QgsVectorDataProvider.AddAttributes:
-            if 'AbsDiff' in fields:
-                model_feedback.pushInfo('AbsDiff field present in soil shapefile')
-                model_feedback.pushInfo('Deleting AbsDiff field...')
-                idx = fields.index('AbsDiff')
-                res = joinedLCFile.dataProvider().deleteAttributes([idx])
-
-            if 'RelDiff' in fields:
-                model_feedback.pushInfo('RelDiff field present in soil shapefile')
-                model_feedback.pushInfo('Deleting RelDiff field...')
-                idx = fields.index('RelDiff')
-                res = joinedLCFile.dataProvider().deleteAttributes([idx])
-                
-            res = joinedLCFile.dataProvider().addAttributes([QgsField('AbsDiff', QVariant.Double), QgsField('RelDiff', QVariant.Double)])
-            joinedLCFile.updateFields()
-
-        with edit(joinedLCFile):
-            for f in joinedLCFile.getFeatures():
-
-                absDiff = float(f['area2_km2']) - float(f['area1_km2'])
-                relDiff = (float(absDiff) / float(f['area1_km2'])) * 100.0
-                
-                f['AbsDiff'] = absDiff
-                f['RelDiff'] = relDiff
-                
-                joinedLCFile.updateFeature(f)
-
-        # Clean up the output file
-        fieldsToKeep = [str(LC_OPENING), str(LC_CLOSING), 'area1_km2', 'area2_km2', 'AbsDiff', 'RelDiff']
-        if str(LC_NAME) != '':
-            fieldsToKeep.append(str(LC_NAME))
-        allFields = [field.name() for field in joinedLCFile.fields()]
-        fieldsToRemove = list(set(allFields) - set(fieldsToKeep))
-
-        idxRemove = []
-        for field in fieldsToRemove:
-            idx = allFields.index(field)
-            idxRemove.append(idx)
+        # Closing code of the same class, and the opening and closing areas with their difference
+        closingField = None
+        if str(LC_CLOSING) not in openingFields:
+            closingField = LC_CLOSING_SHP.fields().field(LC_CLOSING)
 
-        caps = joinedLCFile.dataProvider().capabilities()
-        if caps & QgsVectorDataProvider.DeleteAttributes:
-            res = joinedLCFile.dataProvider().deleteAttributes(idxRemove)
-            joinedLCFile.updateFields()
+        writeAccounts(QgsVectorLayer(OUTPUT_LC), LC_OPENING, closingField, closingAreas)
 
         ####################################
         ### Land cover transition matrix ###
         ####################################
 
-        # Calculate area in intersected LC
-        interLCFile = QgsVectorLayer(intersectLC)
-
-        # Make a new field for area for closing LC
-        if caps & QgsVectorDataProvider.AddAttributes:
-            res = interLCFile.dataProvider().addAttributes([QgsField('area_km2', QVariant.Double)])
-            interLCFile.updateFields()
-
-        # Calculate area for closing LC
-        expContext = QgsExpressionContext()
-        expContext.appendScopes(QgsExpressionContextUtils.globalProjectLayerScopes(interLCFile))
-        exp1 = QgsExpression('area($geometry) / 1000000')
-        
-        with edit(interLCFile):
-            for f in interLCFile.getFeatures():
-                expContext.setFeature(f)
-                f['area_km2'] = exp1.evaluate(expContext)
-                interLCFile.updateFeature(f)
-
-        # Write intersection LC attribute table to file
-        features = interLCFile.getFeatures()
-        fieldnames = [field.name() for field in interLCFile.fields()]
-        
-        with open(intersectCSV,'w', newline='') as output_file:
-            line = ','.join(name for name in fieldnames) + '\n'
-            output_file.write(line)
-
-            for current, f in enumerate(features):
-                if feedback.isCanceled():
-                    break
-
-                line = ','.join(str(f[name]) for name in fieldnames) + '\n'
-                output_file.write(line)
-
-        ############################
-        ### Pivot table creation ###
-        ############################
-
-        hasHeaderRow = True
-        header = []
-        csvData = []
-
-        with open(intersectCSV, "r") as f:
-            reader = csv.reader(f, delimiter=',')
-            for row in reader:
-                if hasHeaderRow and reader.line_num == 1:
-                    header.append(row)
-                    continue # Ignore header row
-                csvData.append(row)
-
-        f.close()
-
-        # Get header
-        headerRow = header[0]
-
         # LC code and name dictionary
         LCnames = {}
 
-        # LC changes [opening, closing, value]
-        LCchanges = []
-
-        for x in range(0, len(csvData)):
-            row = csvData[x]
-
-            # Get data
-            lcOpening = row[headerRow.index(LC_OPENING)]
-            lcName = row[headerRow.index(LC_NAME)]
-            lcClosing = row[headerRow.index(LC_CLOSING)]
-            area = row[headerRow.index('area_km2')]
-
-            # Add lc code and name to dictionary
-            lcPair = {lcOpening: lcName}
-            LCnames.update(lcPair)
-
-            # Add land cover information
-            lcInfo = []
-            lcInfo.append(lcOpening)
-            lcInfo.append(lcClosing)
-            lcInfo.append(area)
-
-            LCchanges.append(lcInfo)
-
-        LCnumpy = np.array(LCchanges)
-        uniqueOpen = np.unique(np.array(LCnumpy[:,0]))
-        uniqueClose = np.unique(np.array(LCnumpy[:,1]))
-        combos = list(itertools.product(uniqueOpen, uniqueClose))
-
-        # Produces a dictionary
-        # Key: (x, y) where x is the LC at open and y is LC at close
-        # Value: area of that combination
-        changeDict = dict(zip(map(tuple, LCnumpy[:,[0,1]]), LCnumpy[:,[2]].ravel().tolist()))
-
-        # Define arrays for the new CSV
-        newHeader = [] # closing LC
-        newColumn = [] # opening LC
-        newCSV = []
-
-        # Loop through the keys in LCnames and get them
-        for key in LCnames:
-            newHeader.append(key)
-            newColumn.append(key)
-
-        # Loop through each land cover in the first column (opening LC)
-        for i in range(0, len(newColumn)):
-
-            # Initialise an empty row first
-            row = ['' for x in range(len(newColumn))]
-
-            # Get the code for the opening cover
-            openCover = newColumn[i]
-
-            # Loop through the dictionary
-            for key in changeDict:
-                openCov = key[0]
-                closeCov = key[1]
-                areaChange = changeDict.get(key,'')
-
-                # If the opening cover in the dictionary
-                # is the cover we are currently analysing
-                if str(openCov) == str(openCover):
-                    j = newHeader.index(str(closeCov))
-                    if str(openCov) == str(closeCov):
-                        row[j] = '' # no change between years
-                    else: # diff LC in open and close
-                        row[j] = areaChange
-            newCSV.append(row)
-
-        # Replace the codes with the actual names
-        namesHeader = ['Change from opening yr (column) to closing yr (row)']
-        namesColumn = []
-        outCSV = []
-
-        for i in range(0, len(newColumn)):
-            openName = LCnames.get(str(newColumn[i]))
-            namesColumn.append(openName)
-
-        for i in range(0, len(newHeader)):    
-            closeName = LCnames.get(str(newHeader[i]))
-            namesHeader.append(closeName)
-
-        outCSV.append(namesHeader)
-
-        for j in range(0, len(namesColumn)):
-            row = newCSV[j]
-            row.insert(0, namesColumn[j])
-            outCSV.append(row)
+        # Area of each (opening, closing) pair
+        pairAreas = {}
+
+        # A single overlay is one tile over the whole opening LC, read in the same way as the tiles
+        # so that the number of tiles does not change which pieces are repaired, skipped or added up
+        tileCount = max(TILES, 1)
+        if tileCount > 1:
+            model_feedback.pushInfo('Intersecting opening and closing land cover in ' + str(tileCount * tileCount) + ' tiles...')
+        else:
+            model_feedback.pushInfo('Intersecting opening and closing land cover...')
+
+        # Workers open the layers read-only with OGR, in the CRS of the opening LC
+        crs = LC_OPENING_SHP.crs()
+        openSource, openName = ogrSource(LC_OPENING_SHP, crs, store, 'openingCopy', context, feedback)
+        closeSource, closeName = ogrSource(LC_CLOSING_SHP, crs, store, 'closingCopy', context, feedback)
+
+        # Each tile only reads the features that hit it, the pieces are never put back together
+        extent = LC_OPENING_SHP.extent()
+        tileWidth = extent.width() / tileCount
+        tileHeight = extent.height() / tileCount
+        tiles = []
+        for row in range(tileCount):
+            for col in range(tileCount):
+                xMin = extent.xMinimum() + col * tileWidth
+                yMin = extent.yMinimum() + row * tileHeight
+                xMax = extent.xMaximum() if col == tileCount - 1 else xMin + tileWidth
+                yMax = extent.yMaximum() if row == tileCount - 1 else yMin + tileHeight
+                tiles.append((xMin, yMin, xMax, yMax))
+
+        pool = processPool(WORKERS) if WORKERS > 1 and len(tiles) > 1 else None
+        try:
+            tileNo = 0
+            skipped = 0
+            for tileAreas, tileNames, tileSkipped in runChunks(pool, intersectTiles, chunkList(tiles, 1),
+                                                  openSource, openName, LC_OPENING, LC_NAME,
+                                                  closeSource, closeName, LC_CLOSING):
+                for pair, area in tileAreas.items():
+                    pairAreas[pair] = pairAreas.get(pair, 0.0) + area
+                for lcOpening, lcName in tileNames.items():
+                    LCnames.setdefault(lcOpening, lcName)
+                skipped += tileSkipped
+
+                tileNo += 1
+                if len(tiles) > 1:
+                    model_feedback.pushInfo('Intersected tile ' + str(tileNo) + ' of ' + str(len(tiles)))
+                if feedback.isCanceled():
+                    return {}
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+        # Invalid geometries are repaired first, pieces that still fail are left out of the matrix
+        if skipped > 0:
+            model_feedback.reportError(str(skipped) + ' pieces with geometries that could not be repaired or intersected '
+                                       'were left out of the transition matrix', False)
 
         # Write the CSV
-        with open(OUTPUT_CSV, 'w', newline='') as csv_file:
-            writer = csv.writer(csv_file, delimiter=',')
-            writer.writerows(outCSV)
-
-        csv_file.close()
+        writeTransitionCSV(OUTPUT_CSV, pairAreas, LCnames)
 
         results[self.OUTPUT] = OUTPUT_LC
         results[self.OUTPUT_CSV] = OUTPUT_CSV
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+
+
+from qgis.PyQt.QtCore import QCoreApplication
+from qgis.core import (QgsProcessing,
+                       QgsProcessingException,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingMultiStepFeedback,
+                       QgsProcessingParameterVectorLayer,
+                       QgsProcessingParameterMultipleLayers,
+                       QgsProcessingParameterField,
+                       QgsProcessingParameterString,
+                       QgsProcessingParameterBoolean,
+                       QgsProcessingParameterFolderDestination,
+                       QgsFeatureRequest,
+                       QgsExpression,
+                       NULL
+                       )
+from qgis import processing
+import csv
+import os
+import re
+import sys
+
+scriptFolder = os.path.dirname(os.path.abspath(__file__))
+if scriptFolder not in sys.path:
+    sys.path.append(scriptFolder)
+
+from NB_modules import ScratchStore, sortedClasses, writeTransitionCSV
+
+class CalcLandExtentEpochs(QgsProcessingAlgorithm):
+
+    INPUT = 'LC_SHP'
+    EPOCH_FIELDS = 'EPOCH_FIELDS'
+    LAYERS = 'LC_LAYERS'
+    LC_FIELD = 'LC_FIELD'
+    LC_NAME = 'LC_NAME'
+    ALL_PAIRS = 'ALL_PAIRS'
+    OUTPUT = 'OUTPUT_FOLDER'
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def createInstance(self):
+        return CalcLandExtentEpochs()
+
+    def name(self):
+        return 'CalcLandExtentEpochs'
+
+    def displayName(self):
+        return self.tr('Calculate land extent accounts (several epochs)')
+
+    def group(self):
+        return self.tr('Nature Braid for SEEA')
+
+    def groupId(self):
+        return 'NBScripts'
+
+    def shortHelpString(self):
+        return self.tr("Calculate land extent accounts for a series of epochs, from one dataset with a field per epoch "
+                       "or from one dataset per epoch, in time order. Datasets per epoch are combined in one union overlay. "
+                       "A transition matrix is written for each pair of consecutive epochs, or for every pair, "
+                       "with the area of each class in each epoch.")
+
+    def initAlgorithm(self, config=None):
+
+        self.addParameter(
+            QgsProcessingParameterVectorLayer(
+            self.INPUT,
+            self.tr('Land cover or extent dataset: one file with a field per epoch'),
+            types=[QgsProcessing.TypeVectorPolygon],
+            optional=True)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterField(
+            self.EPOCH_FIELDS,
+            self.tr('Land extent field of each epoch, in time order'),
+            parentLayerParameterName=self.INPUT,
+            allowMultiple=True,
+            optional=True)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterMultipleLayers(
+            self.LAYERS,
+            self.tr('Land cover or extent datasets: one file per epoch, in time order'),
+            layerType=QgsProcessing.TypeVectorPolygon,
+            optional=True)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterString(
+            self.LC_FIELD,
+            self.tr('Land extent field of the datasets per epoch'),
+            optional=True)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterString(
+            self.LC_NAME,
+            self.tr('Field containing land cover class name, from the first epoch'),
+            optional=True)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterBoolean(
+            self.ALL_PAIRS,
+            self.tr('Write the transition matrix of every pair of epochs, not only consecutive ones'),
+            defaultValue=False)
+        )
+
+        self.addParameter(
+            QgsProcessingParameterFolderDestination(
+            self.OUTPUT,
+            self.tr('Folder for the transition matrices and class areas')
+            )
+        )
+
+    def processAlgorithm(self, parameters, context, model_feedback):
+        # Final inputs and outputs
+        LC_SHP = self.parameterAsVectorLayer(parameters, self.INPUT, context)
+        EPOCH_FIELDS = self.parameterAsFields(parameters, self.EPOCH_FIELDS, context)
+        LC_LAYERS = self.parameterAsLayerList(parameters, self.LAYERS, context)
+        LC_FIELD = self.parameterAsString(parameters, self.LC_FIELD, context)
+        LC_NAME = self.parameterAsString(parameters, self.LC_NAME, context)
+        ALL_PAIRS = self.parameterAsBool(parameters, self.ALL_PAIRS, context)
+        OUTPUT_FOLDER = self.parameterAsString(parameters, self.OUTPUT, context)
+
+        # Intermediate layers
+        store = ScratchStore(context)
+
+        results = {}
+        outputs = {}
+
+        if len(LC_LAYERS) > 0:
+            if LC_FIELD == '':
+                raise QgsProcessingException(self.tr("Give the land extent field of the datasets per epoch"))
+            layers = LC_LAYERS
+            epochs = [layer.name() for layer in LC_LAYERS]
+        elif LC_SHP is not None:
+            layers = [LC_SHP]
+            epochs = EPOCH_FIELDS
+        else:
+            raise QgsProcessingException(self.tr("Give one dataset with a field per epoch, or one dataset per epoch"))
+
+        if len(epochs) < 2:
+            raise QgsProcessingException(self.tr("At least two epochs are needed"))
+
+        # Layers can share a name, so their epochs are told apart by position
+        if len(set(epochs)) < len(epochs):
+            epochs = [str(k + 1) + ' ' + epoch for k, epoch in enumerate(epochs)]
+
+        # Check that the CRS is projected coordinate system
+        for layer in layers:
+            if layer.crs().isGeographic() == True:
+                raise QgsProcessingException(self.tr('Dataset {} must be in a projected CRS').format(layer.name()))
+
+            if layer.crs().mapUnits() != 0:
+                # if it's not in metres
+                raise QgsProcessingException(self.tr('Dataset {} map units must be in meters').format(layer.name()))
+
+        feedback = QgsProcessingMultiStepFeedback(len(layers) + 1, model_feedback)
+
+        if len(LC_LAYERS) > 0:
+            # Keep only the code of each epoch, under its own name, and the class name of the first
+            epochFields = ['nb_epoch' + str(k) for k in range(len(layers))]
+            nameField = 'nb_name' if LC_NAME != '' else ''
+
+            unionLC = None
+            for k, layer in enumerate(layers):
+                model_feedback.pushInfo('Adding epoch ' + epochs[k] + ' to the overlay...')
+
+                if layer.fields().indexOf(LC_FIELD) < 0:
+                    raise QgsProcessingException(self.tr('Dataset {} has no field {}').format(layer.name(), LC_FIELD))
+                field = layer.fields().field(LC_FIELD)
+
+                mapping = [{'expression': QgsExpression.quotedColumnRef(LC_FIELD), 'name': epochFields[k],
+                            'type': field.type(), 'length': field.length(), 'precision': field.precision()}]
+                if k == 0 and nameField != '':
+                    name = layer.fields().field(LC_NAME)
+                    mapping.append({'expression': QgsExpression.quotedColumnRef(LC_NAME), 'name': nameField,
+                                    'type': name.type(), 'length': name.length(), 'precision': name.precision()})
+
+                alg_params = {
+                    'INPUT': layer,
+                    'FIELDS_MAPPING': mapping,
+                    'OUTPUT': store.destination('epoch' + str(k), layer.featureCount())
+                }
+
+                outputs['epoch' + str(k)] = processing.run(
+                    'native:refactorfields',
+                    alg_params, context=context,
+                    feedback=feedback, is_child_algorithm=True
+                )
+                epochLC = store.layer('epoch' + str(k), outputs['epoch' + str(k)]['OUTPUT'])
+
+                # Each epoch goes through the overlay once
+                if unionLC is not None:
+                    alg_params = {
+                        'INPUT': unionLC,
+                        'OVERLAY': epochLC,
+                        'OUTPUT': store.destination('union' + str(k), unionLC.featureCount() + epochLC.featureCount())
+                    }
+
+                    outputs['union' + str(k)] = processing.run(
+                        'native:union',
+                        alg_params, context=context,
+                        feedback=feedback, is_child_algorithm=True
+                    )
+                    epochLC = store.layer('union' + str(k), outputs['union' + str(k)]['OUTPUT'])
+
+                unionLC = epochLC
+
+                feedback.setCurrentStep(k + 1)
+                if feedback.isCanceled():
+                    return {}
+
+        else:
+            # The dataset already holds the code of every epoch on each polygon
+            unionLC = LC_SHP
+            epochFields = EPOCH_FIELDS
+            nameField = LC_NAME
+
+        model_feedback.pushInfo('Adding up the areas of each sequence of classes...')
+
+        # Area of each combination of classes over the epochs, NULL where an epoch has no data
+        sequenceAreas = {}
+
+        # LC code and name dictionary
+        LCnames = {}
+
+        request = QgsFeatureRequest()
+        request.setSubsetOfAttributes(epochFields + ([nameField] if nameField != '' else []), unionLC.fields())
+
+        for f in unionLC.getFeatures(request):
+            if feedback.isCanceled():
+                return {}
+
+            codes = tuple(None if f[field] == NULL else f[field] for field in epochFields)
+            if nameField != '' and codes[0] is not None:
+                LCnames.setdefault(codes[0], f[nameField])
+
+            sequenceAreas[codes] = sequenceAreas.get(codes, 0.0) + f.geometry().area() / 1000000
+
+        # Classes without a name are shown by their code
+        for codes in sequenceAreas:
+            for code in codes:
+                if code is not None:
+                    LCnames.setdefault(code, code)
+
+        os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+
+        # Area of each class in each epoch
+        totals = {}
+        for codes, area in sequenceAreas.items():
+            for k, code in enumerate(codes):
+                if code is not None:
+                    totals.setdefault(code, [0.0] * len(epochs))[k] += area
+
+        with open(os.path.join(OUTPUT_FOLDER, 'class_areas.csv'), 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file, delimiter=',')
+            writer.writerow(['Class area (km2)'] + epochs)
+            # Classes in the same order as the rows and columns of the transition matrices
+            for code in sortedClasses(totals):
+                writer.writerow([LCnames.get(code)] + totals[code])
+
+        # Transition matrix of each pair of epochs, from the areas covered in both
+        if ALL_PAIRS:
+            pairs = [(i, j) for i in range(len(epochs)) for j in range(i + 1, len(epochs))]
+        else:
+            pairs = [(i, i + 1) for i in range(len(epochs) - 1)]
+
+        for i, j in pairs:
+            pairAreas = {}
+            for codes, area in sequenceAreas.items():
+                if codes[i] is None or codes[j] is None:
+                    continue
+                pair = (codes[i], codes[j])
+                pairAreas[pair] = pairAreas.get(pair, 0.0) + area
+
+            # The position of the epochs keeps the file names apart, the names are only a hint
+            fileName = 'transition_' + str(i + 1) + '_' + str(j + 1) + '_' + epochs[i] + '_' + epochs[j]
+            path = os.path.join(OUTPUT_FOLDER, re.sub(r'[^\w.-]+', '_', fileName) + '.csv')
+            writeTransitionCSV(path, pairAreas, LCnames)
+
+        feedback.setCurrentStep(len(layers) + 1)
+
+        results[self.OUTPUT] = OUTPUT_FOLDER
+
+        return results
@@ -8,13 +8,19 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingAlgorithm,
                        QgsProcessingMultiStepFeedback,
                        QgsProcessingParameterVectorLayer,
-                       QgsProcessingUtils,
                        QgsProcessingParameterField,
                        QgsProcessingParameterVectorDestination,
                        QgsProcessingParameterFileDestination
                        )
 from qgis import processing
 import os
+import sys
+
+scriptFolder = os.path.dirname(os.path.abspath(__file__))
+if scriptFolder not in sys.path:
+    sys.path.append(scriptFolder)
+
+from NB_modules import ScratchStore
 
 class CalcLandExtentMultFiles(QgsProcessingAlgorithm):
 
@@ -117,12 +123,8 @@ class CalcLandExtentMultFiles(QgsProcessingAlgorithm):
         OUTPUT_CSV = self.parameterAsFileOutput(parameters, self.OUTPUT_CSV, context)
         LC_NAME =  self.parameterAsString(parameters, self.LC_NAME, context)
 
-        # Temporary files
-        tempFolder = os.path.join(QgsProcessingUtils.tempFolder(), 'calc_lc_two')
-        if not os.path.exists(tempFolder):
-            os.mkdir(tempFolder)
-        openingLC = os.path.join(tempFolder, 'openingLC.shp')
-        closingLC = os.path.join(tempFolder, 'closingLC.shp')
+        # Intermediate layers
+        store = ScratchStore(context)
 
         feedback = QgsProcessingMultiStepFeedback(2, model_feedback)
         results = {}
@@ -152,7 +154,7 @@ class CalcLandExtentMultFiles(QgsProcessingAlgorithm):
         # Dissolve opening LC
         alg_params = {'INPUT': LC_OPENING_SHP,
             'FIELD':[LC_OPENING],
-            'OUTPUT': openingLC
+            'OUTPUT': store.destination('openingLC', LC_OPENING_SHP.featureCount())
         }
         
         outputs['openingDissolve'] = processing.run(
@@ -168,10 +170,10 @@ class CalcLandExtentMultFiles(QgsProcessingAlgorithm):
         # Dissolve closing LC
         alg_params = {'INPUT': LC_CLOSING_SHP,
             'FIELD':[LC_CLOSING],
-            'OUTPUT': closingLC
+            'OUTPUT': store.destination('closingLC', LC_CLOSING_SHP.featureCount())
         }
         
-        outputs['openingDissolve'] = processing.run(
+        outputs['closingDissolve'] = processing.run(
             'native:dissolve',
             alg_params, context=context,
             feedback=feedback, is_child_algorithm=True
@@ -182,9 +184,12 @@ class CalcLandExtentMultFiles(QgsProcessingAlgorithm):
             return {}
 
         # Call the calculation function here
-        alg_params = {'LC_OPENING_SHP': openingLC,
+        openingLC = store.layer('openingLC', outputs['openingDissolve']['OUTPUT'])
+        closingLC = store.layer('closingLC', outputs['closingDissolve']['OUTPUT'])
+
+        alg_params = {'LC_OPENING_SHP': store.reference('openingLC', openingLC),
             'LC_OPENING': LC_OPENING,
-            'LC_CLOSING_SHP': closingLC,
+            'LC_CLOSING_SHP': store.reference('closingLC', closingLC),
             'LC_CLOSING': LC_CLOSING,
             'LC_NAME': LC_NAME,
             'OUTPUT_CSV': OUTPUT_CSV,
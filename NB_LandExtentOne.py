@@ -8,13 +8,23 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingAlgorithm,
                        QgsProcessingMultiStepFeedback,
                        QgsProcessingParameterVectorLayer,
-                       QgsProcessingUtils,
                        QgsProcessingParameterField,
                        QgsProcessingParameterVectorDestination,
-                       QgsProcessingParameterFileDestination
+                       QgsProcessingParameterFileDestination,
+                       QgsProcessingParameterEnum,
+                       QgsVectorLayer,
+                       QgsFeature,
+                       QgsFeatureRequest
                        )
 from qgis import processing
 import os
+import sys
+
+scriptFolder = os.path.dirname(os.path.abspath(__file__))
+if scriptFolder not in sys.path:
+    sys.path.append(scriptFolder)
+
+from NB_modules import ScratchStore, writeAccounts, writeTransitionCSV, sortedClasses
 
 class CalcLandExtentOneFile(QgsProcessingAlgorithm):
 
@@ -22,6 +32,7 @@ class CalcLandExtentOneFile(QgsProcessingAlgorithm):
     LC_OPENING = 'LC_OPENING'
     LC_CLOSING = 'LC_CLOSING'
     LC_NAME = 'LC_NAME'
+    METHOD = 'METHOD'
     OUTPUT_CSV = 'OUTPUT_CSV'
     OUTPUT = 'LC_ACCOUNTS'
 
@@ -44,7 +55,9 @@ class CalcLandExtentOneFile(QgsProcessingAlgorithm):
         return 'NBScripts'
 
     def shortHelpString(self):
-        return self.tr("Calculate land extent accounts from one land cover or extent dataset")
+        return self.tr("Calculate land extent accounts from one land cover or extent dataset. "
+                       "The attribute totals method reads the areas of the polygons once, with no dissolve or overlay, "
+                       "and writes the accounts as a table without geometry.")
 
     def initAlgorithm(self, config=None):
         
@@ -83,6 +96,16 @@ class CalcLandExtentOneFile(QgsProcessingAlgorithm):
             )
         )
 
+        self.addParameter(
+            QgsProcessingParameterEnum(
+            self.METHOD,
+            self.tr('Calculation method'),
+            options=[self.tr('Overlay of the dissolved opening and closing extents'),
+                     self.tr('Attribute totals of the polygons (accounts written as a table without geometry)')],
+            defaultValue=0,
+            optional=True)
+        )
+
         self.addParameter(
             QgsProcessingParameterFileDestination(
             self.OUTPUT_CSV,
@@ -94,7 +117,7 @@ class CalcLandExtentOneFile(QgsProcessingAlgorithm):
         self.addParameter(
             QgsProcessingParameterVectorDestination(
             self.OUTPUT,
-            self.tr('Land cover accounts')
+            self.tr('Land cover accounts (a table without geometry with the attribute totals method)')
             )
         )
         
@@ -106,13 +129,10 @@ class CalcLandExtentOneFile(QgsProcessingAlgorithm):
         LC_ACCOUNTS = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)        
         OUTPUT_CSV = self.parameterAsFileOutput(parameters, self.OUTPUT_CSV, context)
         LC_NAME =  self.parameterAsString(parameters, self.LC_NAME, context)
+        METHOD = self.parameterAsEnum(parameters, self.METHOD, context)
 
-        # Temporary files
-        tempFolder = os.path.join(QgsProcessingUtils.tempFolder(), 'calc_lc_one')
-        if not os.path.exists(tempFolder):
-            os.mkdir(tempFolder)
-        openingLC = os.path.join(tempFolder, 'openingLC.shp')
-        closingLC = os.path.join(tempFolder, 'closingLC.shp')
+        # Intermediate layers
+        store = ScratchStore(context)
 
         # Check that the CRS is projected coordinate system
         landCoverGeo = LC_SHP.crs().isGeographic()
@@ -129,10 +149,78 @@ class CalcLandExtentOneFile(QgsProcessingAlgorithm):
         results = {}
         outputs = {}
 
+        if METHOD == 1:
+            # Each polygon has one opening and one closing class, so its area goes straight to that pair
+            model_feedback.pushInfo('Adding up the areas of the polygons...')
+
+            pairAreas = {}
+            openingAreas = {}
+            closingAreas = {}
+
+            # LC code and name dictionary
+            LCnames = {}
+
+            request = QgsFeatureRequest()
+            request.setSubsetOfAttributes([LC_OPENING, LC_CLOSING, LC_NAME], LC_SHP.fields())
+
+            for f in LC_SHP.getFeatures(request):
+                if feedback.isCanceled():
+                    return {}
+
+                lcOpening = f[LC_OPENING]
+                lcClosing = f[LC_CLOSING]
+                area = f.geometry().area() / 1000000
+
+                LCnames.setdefault(lcOpening, f[LC_NAME])
+                pair = (lcOpening, lcClosing)
+                pairAreas[pair] = pairAreas.get(pair, 0.0) + area
+                openingAreas[lcOpening] = openingAreas.get(lcOpening, 0.0) + area
+                closingAreas[lcClosing] = closingAreas.get(lcClosing, 0.0) + area
+
+            # One row per opening class with its code and name, as the dissolve gives
+            accountFields = [LC_SHP.fields().field(LC_OPENING)]
+            if LC_NAME != '' and LC_NAME != LC_OPENING:
+                accountFields.append(LC_SHP.fields().field(LC_NAME))
+
+            accounts = QgsVectorLayer('None', 'accounts', 'memory')
+            accounts.dataProvider().addAttributes(accountFields)
+            accounts.updateFields()
+
+            # Classes in the order of the overlay accounts and of the transition matrix
+            rows = []
+            for lcOpening in sortedClasses(LCnames):
+                row = QgsFeature(accounts.fields())
+                row.setAttributes([lcOpening, LCnames[lcOpening]][:len(accountFields)])
+                rows.append(row)
+            accounts.dataProvider().addFeatures(rows)
+
+            closingField = None
+            if LC_CLOSING != LC_OPENING and LC_CLOSING != LC_NAME:
+                closingField = LC_SHP.fields().field(LC_CLOSING)
+
+            writeAccounts(accounts, LC_OPENING, closingField, closingAreas, openingAreas)
+            writeTransitionCSV(OUTPUT_CSV, pairAreas, LCnames)
+
+            alg_params = {
+                'INPUT': accounts,
+                'OUTPUT': LC_ACCOUNTS
+            }
+
+            outputs['saveAccounts'] = processing.run(
+                'native:savefeatures',
+                alg_params, context=context,
+                feedback=feedback, is_child_algorithm=True
+            )
+
+            results[self.OUTPUT] = LC_ACCOUNTS
+            results[self.OUTPUT_CSV] = OUTPUT_CSV
+
+            return results
+
         # Dissolve opening LC
         alg_params = {'INPUT': LC_SHP,
             'FIELD':[LC_OPENING],
-            'OUTPUT': openingLC
+            'OUTPUT': store.destination('openingLC', LC_SHP.featureCount())
         }
         
         outputs['openingDissolve'] = processing.run(
@@ -148,10 +236,10 @@ class CalcLandExtentOneFile(QgsProcessingAlgorithm):
         # Dissolve closing LC
         alg_params = {'INPUT': LC_SHP,
             'FIELD':[LC_CLOSING],
-            'OUTPUT': closingLC
+            'OUTPUT': store.destination('closingLC', LC_SHP.featureCount())
         }
         
-        outputs['openingDissolve'] = processing.run(
+        outputs['closingDissolve'] = processing.run(
             'native:dissolve',
             alg_params, context=context,
             feedback=feedback, is_child_algorithm=True
@@ -162,9 +250,12 @@ class CalcLandExtentOneFile(QgsProcessingAlgorithm):
             return {}
 
         # Call the calculation function here
-        alg_params = {'LC_OPENING_SHP': openingLC,
+        openingLC = store.layer('openingLC', outputs['openingDissolve']['OUTPUT'])
+        closingLC = store.layer('closingLC', outputs['closingDissolve']['OUTPUT'])
+
+        alg_params = {'LC_OPENING_SHP': store.reference('openingLC', openingLC),
             'LC_OPENING': LC_OPENING,
-            'LC_CLOSING_SHP': closingLC,
+            'LC_CLOSING_SHP': store.reference('closingLC', closingLC),
             'LC_CLOSING': LC_CLOSING,
             'LC_NAME': LC_NAME,
             'OUTPUT_CSV': OUTPUT_CSV,
@@ -0,0 +1,205 @@
+'''
+Nature Braid for SEEA
+
+Persistent cache of rasterized species ranges
+
+Presence is stored per species and per block of a lattice anchored at
+(0, 0), so runs with the same CRS and resolution share cached blocks
+whatever their extent. A species is identified by its ID and a hash of all
+its features in the source, so changed ranges are burnt again. The keys of
+each source are kept in the same folder, see NB_modules.speciesKeys. Only
+GDAL/OGR, NumPy and the standard library are used, so the cache can be used
+in worker processes.
+'''
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from NB_checkpoint import replaceFile
+from NB_rasterise import RasterGrid
+
+
+class RangeCache:
+    # Cached presence blocks of one CRS and resolution
+
+    def __init__(self, folder, crsWkt, res, blockSize=256, method='centre'):
+        # method tells how presence was burnt, runs burning in another way do not share blocks
+        gridKey = '\n'.join([crsWkt, repr(float(res)), '0 0', str(blockSize), method])
+
+        self.root = folder
+        self.folder = os.path.join(folder, hashlib.sha1(gridKey.encode('utf-8')).hexdigest())
+        self.crsWkt = crsWkt
+        self.res = res
+        self.blockSize = blockSize
+
+    def speciesKey(self, speciesID, features):
+        # Same ID and same features (WKB, as bytes) give the same key, in any feature order
+        digest = hashlib.sha1(str(speciesID).encode('utf-8'))
+        for wkb in sorted(features):
+            digest.update(hashlib.sha1(wkb).digest())
+
+        return digest.hexdigest()
+
+    def groupKey(self, key, group):
+        # Key of the ranges of a species in one group
+        return hashlib.sha1((key + ' group ' + str(group)).encode('utf-8')).hexdigest()
+
+    def simplifiedKey(self, key, tolerance):
+        # Key of the ranges of a species simplified with the given tolerance
+        return hashlib.sha1((key + ' ' + repr(float(tolerance))).encode('utf-8')).hexdigest()
+
+    def blockGrid(self, grid):
+        # Smallest grid of whole lattice blocks that covers the grid
+        # The grid has to lie on the lattice, see RasterGrid.snapped
+        col0 = int(round(grid.originX / self.res))
+        row0 = int(round(-grid.originY / self.res))
+
+        bx0 = col0 // self.blockSize
+        by0 = row0 // self.blockSize
+        bx1 = -(-(col0 + grid.width) // self.blockSize)
+        by1 = -(-(row0 + grid.height) // self.blockSize)
+
+        blocks = RasterGrid(bx0 * self.blockSize * self.res,
+                            -by0 * self.blockSize * self.res,
+                            self.res,
+                            (bx1 - bx0) * self.blockSize,
+                            (by1 - by0) * self.blockSize,
+                            grid.crsWkt)
+
+        # Offset of the grid in the block grid, in pixels
+        offset = (col0 - bx0 * self.blockSize, row0 - by0 * self.blockSize)
+
+        return blocks, (bx0, by0), offset
+
+    def keysPath(self, sourceKey):
+        # Species keys of a source are shared by all resolutions
+        return os.path.join(self.root, 'sources', sourceKey + '.json')
+
+    def readKeys(self, sourceKey):
+        # Species keys (ID as text: key) computed before for a source, empty if there are none
+        try:
+            with open(self.keysPath(sourceKey), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def writeKeys(self, sourceKey, keys):
+        path = self.keysPath(sourceKey)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        replaceFile(path, lambda f: json.dump(keys, f), mode='w')
+
+    def path(self, key, bx, by):
+        return os.path.join(self.folder, key[:2], key, str(bx) + '_' + str(by) + '.bin')
+
+    def read(self, key, bx, by):
+        # Presence of a block, None if it is not cached
+        path = self.path(key, bx, by)
+        try:
+            with open(path, 'rb') as f:
+                packed = f.read()
+        except OSError:
+            return None
+
+        # Reading a block makes it the most recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        if len(packed) == 0:
+            return np.zeros((self.blockSize, self.blockSize), dtype=np.uint8)
+
+        bits = np.unpackbits(np.frombuffer(packed, dtype=np.uint8), count=self.blockSize * self.blockSize)
+        return bits.reshape(self.blockSize, self.blockSize)
+
+    def write(self, key, bx, by, presence):
+        # Blocks without presence are stored as empty files
+        path = self.path(key, bx, by)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmpPath = path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            if presence.any():
+                f.write(np.packbits(presence, axis=None).tobytes())
+
+        # Other runs never see a partly written block
+        os.replace(tmpPath, path)
+
+    def presence(self, key, grid, geometries, burner):
+        # Presence (0/1) of a species on the grid, read from the cache where possible
+        # burner is a SpeciesBurner on the block grid of the grid
+        # geometries can be a function, only called when the ranges have to be burnt
+        # The returned array is a view of the burner buffer, overwritten by the next call
+        blocks, (bx0, by0), (xOff, yOff) = self.blockGrid(grid)
+        size = self.blockSize
+        nbx = blocks.width // size
+        nby = blocks.height // size
+
+        buffer = burner.buffer
+        missing = False
+
+        for j in range(nby):
+            for i in range(nbx):
+                block = self.read(key, bx0 + i, by0 + j)
+                if block is None:
+                    missing = True
+                    break
+                buffer[j * size:(j + 1) * size, i * size:(i + 1) * size] = block
+            if missing:
+                break
+
+        if missing:
+            if callable(geometries):
+                geometries = geometries()
+            buffer = burner.burn(geometries)
+            for j in range(nby):
+                for i in range(nbx):
+                    self.write(key, bx0 + i, by0 + j, buffer[j * size:(j + 1) * size, i * size:(i + 1) * size])
+
+        return buffer[yOff:yOff + grid.height, xOff:xOff + grid.width]
+
+    def evict(self, limitMB):
+        # Remove the least recently used blocks until the whole cache folder fits the limit
+        # Returns the number of files removed
+        files = []
+        total = 0
+        for folder, dirs, names in os.walk(self.root):
+            for name in names:
+                if not name.endswith('.bin'):
+                    continue
+
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                # Empty blocks still take a file system block
+                size = max(stat.st_size, 4096)
+                files.append((stat.st_mtime, size, path))
+                total += size
+
+        limit = limitMB * 1024 * 1024
+        removed = 0
+        for mtime, size, path in sorted(files):
+            if total <= limit:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            total -= size
+            removed += 1
+
+            # Drop the folder of a species once all its blocks are gone
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass
+
+        return removed
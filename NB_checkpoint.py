@@ -0,0 +1,141 @@
+'''
+Nature Braid for SEEA
+
+Run manifests for resuming long runs
+
+A manifest lists the finished parts of a run and the files holding their
+results, in a folder that outlives the run. A later run with the same
+inputs can then skip the finished parts. Each result is written to a new
+file before the manifest points to it, so a run stopped at any moment
+leaves a consistent manifest behind.
+'''
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+def fingerprint(values):
+    # Hash of the inputs and settings of a run
+    return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def fileStamp(path):
+    # Size and modification time of a file, to notice changed inputs
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return [stat.st_size, stat.st_mtime]
+
+
+def replaceFile(path, write, mode='wb'):
+    # Write a file under a temporary name and move it into place
+    tmpPath = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmpPath, mode) as f:
+        write(f)
+
+    os.replace(tmpPath, path)
+
+
+class RunManifest:
+
+    def __init__(self, folder, name, runFingerprint, resume=True):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.name = name
+        self.path = os.path.join(folder, name + '.json')
+        self.fingerprint = runFingerprint
+        self.parts = {}
+        self.counter = 0
+
+        previous = self.read()
+        if previous is not None and resume and previous.get('fingerprint') == runFingerprint:
+            self.parts = previous.get('parts', {})
+            self.counter = previous.get('counter', 0)
+        elif previous is not None:
+            # Results of other inputs, or a fresh start
+            for entry in previous.get('parts', {}).values():
+                self.removeFiles(entry)
+
+        self.write()
+
+    def read(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write(self):
+        state = {'fingerprint': self.fingerprint, 'counter': self.counter, 'parts': self.parts}
+        replaceFile(self.path, lambda f: json.dump(state, f), mode='w')
+
+    def __contains__(self, key):
+        return key in self.parts
+
+    def keys(self):
+        return list(self.parts)
+
+    def info(self, key):
+        return self.parts[key]['info']
+
+    def record(self, key, arrays=None, data=None, **info):
+        # Results of a finished part: arrays go to a compressed NumPy archive, data to a JSON file
+        # Values that JSON cannot hold, such as NULL attributes, are stored as null
+        self.counter += 1
+        stem = self.name + '_' + str(self.counter)
+        entry = {'info': info}
+
+        if arrays is not None:
+            entry['arrays'] = stem + '.npz'
+            replaceFile(os.path.join(self.folder, entry['arrays']), lambda f: np.savez_compressed(f, **arrays))
+
+        if data is not None:
+            entry['data'] = stem + '.json'
+            replaceFile(os.path.join(self.folder, entry['data']),
+                        lambda f: json.dump(data, f, default=lambda value: None), mode='w')
+
+        previous = self.parts.get(key)
+        self.parts[key] = entry
+        self.write()
+
+        if previous is not None:
+            self.removeFiles(previous)
+
+    def arrays(self, key):
+        with np.load(os.path.join(self.folder, self.parts[key]['arrays']), allow_pickle=False) as archive:
+            return {name: archive[name] for name in archive.files}
+
+    def data(self, key):
+        with open(os.path.join(self.folder, self.parts[key]['data']), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def discard(self, key):
+        entry = self.parts.pop(key, None)
+        if entry is not None:
+            self.write()
+            self.removeFiles(entry)
+
+    def clear(self):
+        # Remove the manifest and all results once the run is complete
+        for entry in self.parts.values():
+            self.removeFiles(entry)
+        self.parts = {}
+
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def removeFiles(self, entry):
+        for name in (entry.get('arrays'), entry.get('data')):
+            if name is None:
+                continue
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                pass
@@ -16,7 +16,15 @@ from qgis.core import (QgsProcessing,
                        QgsProcessingException,
                        edit)
 from qgis import processing
+import math
 import os
+import sys
+
+scriptFolder = os.path.dirname(os.path.abspath(__file__))
+if scriptFolder not in sys.path:
+    sys.path.append(scriptFolder)
+
+from NB_modules import ScratchStore
 
 class createGrid(QgsProcessingAlgorithm):
 
@@ -89,12 +97,8 @@ class createGrid(QgsProcessingAlgorithm):
         GRID_OPTION = self.parameterAsEnum(parameters, self.GRID_OPTION, context)
         AGG_GRID = self.parameterAsOutputLayer(parameters, self.OUTPUT, context)        
         
-        # Intermediate files
-        tempFolder = os.path.join(QgsProcessingUtils.tempFolder(), 'aggregation')
-        if not os.path.exists(tempFolder):
-            os.mkdir(tempFolder)
-        gridInitial = os.path.join(tempFolder, 'gridInitial.shp')
-        vectorOverlap = os.path.join(tempFolder, 'vectorOverlap.shp')
+        # Intermediate layers
+        store = ScratchStore(context)
 
         feedback = QgsProcessingMultiStepFeedback(2, model_feedback)
         results = {}
@@ -139,13 +143,15 @@ class createGrid(QgsProcessingAlgorithm):
         elif GRID_OPTION == 1:
             model_feedback.pushInfo('Study area extent selected')
             # Create grid
+            gridCells = math.ceil(samExtent.width() / GRID_SIZE) * math.ceil(samExtent.height() / GRID_SIZE)
+
             alg_params = {
                 'TYPE': 2,
                 'EXTENT': SAM,
                 'HSPACING': GRID_SIZE,
                 'VSPACING': GRID_SIZE,
                 'CRS': samCRS,
-                'OUTPUT': gridInitial
+                'OUTPUT': store.destination('gridInitial', gridCells)
             }
 
             outputs['createGrid'] = processing.run(
@@ -159,7 +165,7 @@ class createGrid(QgsProcessingAlgorithm):
                 return {}
 
             alg_params = {
-                'INPUT': gridInitial,
+                'INPUT': store.layer('gridInitial', outputs['createGrid']['OUTPUT']),
                 'LAYERS': [SAM],
                 'OUTPUT': AGG_GRID
             }
@@ -0,0 +1,142 @@
+'''
+Nature Braid for SEEA
+
+Vectorised metric kernels
+
+Only NumPy is needed, so these can be used and checked without QGIS.
+'''
+
+import numpy as np
+
+# Metrics returned by diversityMetrics, in output column order
+DIVERSITY_FIELDS = ['NUM_COVERS', 'SHANNON', 'INVSIMPSON', 'SIMPSON', 'EVENNESS', 'BERGERPARK', 'NUM_PATCH', 'MEANPATCH']
+
+
+def factorize(values):
+    # Integer code for each value, codes follow the order of first appearance
+    # Works for any hashable values, including None (NULL)
+    lookup = {}
+    codes = np.fromiter((lookup.setdefault(value, len(lookup)) for value in values), dtype=np.int64, count=len(values))
+
+    return codes, list(lookup)
+
+
+def diversityMetrics(unitIndex, classIndex, areas, unitSizes):
+    '''
+    Diversity metrics of every unit from a sparse (unit, class, area) table
+
+    unitIndex: index into unitSizes of the unit of each patch
+    classIndex: integer class code of each patch (see factorize)
+    areas: area of each patch, in square metres
+    unitSizes: area of each unit, in square metres
+
+    Each row of the table is one patch, patches of the same class in a unit
+    add up to the class area. Proportions are relative to the unit size.
+
+    Returns a dictionary of arrays with one value per unit:
+    NUM_COVERS  number of classes
+    SHANNON     Shannon index, -sum(p ln p)
+    INVSIMPSON  inverse Simpson index, 1 / sum(p^2)
+    SIMPSON     Simpson diversity, 1 - sum(p^2)
+    EVENNESS    Pielou evenness, SHANNON / ln(NUM_COVERS), 0 with one class
+    BERGERPARK  Berger-Parker dominance, largest class area / area covered
+    NUM_PATCH   number of patches
+    MEANPATCH   mean patch area in hectares
+
+    Units without data get 0 patches and covers, and -1 for the indices.
+    '''
+    unitIndex = np.asarray(unitIndex, dtype=np.int64)
+    classIndex = np.asarray(classIndex, dtype=np.int64)
+    areas = np.asarray(areas, dtype=np.float64)
+    unitSizes = np.asarray(unitSizes, dtype=np.float64)
+    numUnits = len(unitSizes)
+
+    # Patches with no area do not count
+    keep = areas > 0
+    unitIndex = unitIndex[keep]
+    classIndex = classIndex[keep]
+    areas = areas[keep]
+
+    # Patch metrics
+    numPatch = np.bincount(unitIndex, minlength=numUnits)
+    patchTotal = np.bincount(unitIndex, weights=areas, minlength=numUnits).astype(np.float64)
+    meanPatch = np.zeros(numUnits)
+    hasData = numPatch > 0
+    meanPatch[hasData] = patchTotal[hasData] / numPatch[hasData] / 10000
+
+    # Class area of each (unit, class) pair, pairs come out sorted by unit
+    numClasses = int(classIndex.max()) + 1 if len(classIndex) > 0 else 1
+    pairKey = unitIndex * numClasses + classIndex
+    pairs, pairIndex = np.unique(pairKey, return_inverse=True)
+    pairArea = np.bincount(pairIndex.ravel(), weights=areas, minlength=len(pairs)).astype(np.float64)
+    pairUnit = pairs // numClasses
+
+    prob = pairArea / unitSizes[pairUnit]
+
+    numCovers = np.bincount(pairUnit, minlength=numUnits)
+    shannon = -np.bincount(pairUnit, weights=prob * np.log(prob), minlength=numUnits).astype(np.float64)
+    sumSquares = np.bincount(pairUnit, weights=prob * prob, minlength=numUnits).astype(np.float64)
+    sumProb = np.bincount(pairUnit, weights=prob, minlength=numUnits).astype(np.float64)
+
+    maxProb = np.zeros(numUnits)
+    if len(pairs) > 0:
+        starts = np.flatnonzero(np.r_[True, pairUnit[1:] != pairUnit[:-1]])
+        maxProb[pairUnit[starts]] = np.maximum.reduceat(prob, starts)
+
+    hasCovers = numCovers > 0
+    manyCovers = numCovers > 1
+
+    invSimpson = np.full(numUnits, -1.0)
+    simpson = np.full(numUnits, -1.0)
+    evenness = np.full(numUnits, -1.0)
+    bergerParker = np.full(numUnits, -1.0)
+
+    invSimpson[hasCovers] = 1 / sumSquares[hasCovers]
+    simpson[hasCovers] = 1 - sumSquares[hasCovers]
+    evenness[hasCovers] = 0.0
+    evenness[manyCovers] = shannon[manyCovers] / np.log(numCovers[manyCovers])
+    bergerParker[hasCovers] = maxProb[hasCovers] / sumProb[hasCovers]
+    shannon[~hasCovers] = -1.0
+
+    return {
+        'NUM_COVERS': numCovers,
+        'SHANNON': shannon,
+        'INVSIMPSON': invSimpson,
+        'SIMPSON': simpson,
+        'EVENNESS': evenness,
+        'BERGERPARK': bergerParker,
+        'NUM_PATCH': numPatch,
+        'MEANPATCH': meanPatch
+    }
+
+
+def transitionMatrix(openIndex, closeIndex, areas, numClasses, sparse=False):
+    '''
+    Area moving between classes from a (opening class, closing class, area) table
+
+    openIndex: integer class code at opening of each piece (see factorize)
+    closeIndex: integer class code at closing of each piece
+    areas: area of each piece
+    numClasses: number of class codes, both axes use the same codes
+
+    Pieces with the same pair of classes add up.
+
+    Returns a dense numClasses x numClasses array, rows are the opening
+    class and columns the closing class. With sparse, returns the arrays
+    (rows, columns, areas) of the pairs that have pieces instead, sorted by
+    row then column, for classifications too detailed for a dense matrix.
+    '''
+    openIndex = np.asarray(openIndex, dtype=np.int64)
+    closeIndex = np.asarray(closeIndex, dtype=np.int64)
+    areas = np.asarray(areas, dtype=np.float64)
+
+    pairKey = openIndex * numClasses + closeIndex
+
+    if not sparse:
+        matrix = np.bincount(pairKey, weights=areas, minlength=numClasses * numClasses)
+        return matrix.astype(np.float64).reshape(numClasses, numClasses)
+
+    pairs, pairIndex = np.unique(pairKey, return_inverse=True)
+    pairArea = np.bincount(pairIndex.ravel(), weights=areas, minlength=len(pairs)).astype(np.float64)
+
+    return pairs // numClasses, pairs % numClasses, pairArea
@@ -0,0 +1,421 @@
+'''
+Nature Braid for SEEA
+
+Shared helpers for the processing scripts
+'''
+
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import (QgsProviderRegistry,
+                       QgsProcessingUtils,
+                       QgsFeatureRequest,
+                       QgsVectorFileWriter,
+                       QgsVectorLayer,
+                       QgsDistanceArea,
+                       QgsGeometry,
+                       QgsRectangle,
+                       QgsField,
+                       QgsVectorDataProvider,
+                       QgsProcessingException,
+                       NULL)
+from qgis import processing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import csv
+import os
+import sys
+import numpy as np
+
+from NB_checkpoint import fileStamp, fingerprint
+from NB_metrics import factorize, transitionMatrix
+
+# Intermediate layers with more features than this go to the scratch GeoPackage
+MEMORY_FEATURE_LIMIT = 250000
+
+# Number of features changed per provider call when writing attributes
+WRITE_BATCH_SIZE = 50000
+
+
+class ScratchStore:
+    # Intermediate layers of one algorithm run
+    # Small layers are kept as memory layers, large ones share one scratch GeoPackage
+
+    def __init__(self, context, limit=MEMORY_FEATURE_LIMIT):
+        self.gpkg = QgsProcessingUtils.generateTempFilename('scratch.gpkg')
+        self.context = context
+        self.limit = limit
+        self.onDisk = set()
+
+    def useDisk(self, name, featureCount, onDisk):
+        if onDisk or featureCount > self.limit:
+            self.onDisk.add(name)
+        else:
+            self.onDisk.discard(name)
+
+        return name in self.onDisk
+
+    def destination(self, name, featureCount, onDisk=False):
+        # Output value for a child algorithm that writes the intermediate layer
+        if self.useDisk(name, featureCount, onDisk):
+            return "ogr:dbname='" + self.gpkg + "' table=\"" + name + "\" (geom)"
+
+        return 'memory:' + name
+
+    def layer(self, name, result):
+        # Intermediate layer written by a child algorithm
+        if name in self.onDisk:
+            return QgsVectorLayer(self.source(name), name, 'ogr')
+
+        return QgsProcessingUtils.mapLayerFromString(result, self.context)
+
+    def reference(self, name, layer):
+        # String that child algorithms resolve back to the intermediate layer
+        if name in self.onDisk:
+            return self.source(name)
+
+        return layer.id()
+
+    def source(self, name):
+        # OGR data source of an intermediate layer kept on disk
+        return self.gpkg + '|layername=' + name
+
+    def copy(self, layer, name, onDisk=False):
+        # Copy of a layer that can be edited without touching the original
+        if not self.useDisk(name, layer.featureCount(), onDisk):
+            copied = layer.materialize(QgsFeatureRequest())
+            copied.setName(name)
+            self.context.temporaryLayerStore().addMapLayer(copied)
+            return copied
+
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = 'GPKG'
+        options.layerName = name
+        options.fileEncoding = 'utf-8'
+        if os.path.exists(self.gpkg):
+            options.actionOnExistingFile = QgsVectorFileWriter.CreateOrOverwriteLayer
+
+        writer = QgsVectorFileWriter.writeAsVectorFormatV2(layer, self.gpkg, self.context.transformContext(), options)
+        del(writer)
+
+        return self.layer(name, None)
+
+
+class AttributeWriter:
+    # Writes attribute values straight to the provider in batched changeAttributeValues calls
+    # Values are buffered per feature and flushed every batchSize features
+
+    def __init__(self, layer, fieldNames, batchSize=WRITE_BATCH_SIZE):
+        self.layer = layer
+        self.provider = layer.dataProvider()
+        self.fieldIdx = [layer.fields().indexOf(name) for name in fieldNames]
+        self.batchSize = batchSize
+        self.changes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.flush()
+
+    def write(self, featureID, values):
+        # values are given in the order of fieldNames
+        self.changes[featureID] = dict(zip(self.fieldIdx, values))
+        if len(self.changes) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if len(self.changes) > 0:
+            if not self.provider.changeAttributeValues(self.changes):
+                raise QgsProcessingException('Could not write attributes to ' + self.layer.name())
+            self.changes = {}
+
+
+def attributeRequest(layer, fieldNames):
+    # Request for a few attributes only, without fetching geometries
+    request = QgsFeatureRequest().setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(fieldNames, layer.fields())
+
+    return request
+
+
+def writeAreaField(layer, fieldName, divisor, batchSize=WRITE_BATCH_SIZE):
+    # Planar area of each feature divided by divisor, written to an existing field
+    with AttributeWriter(layer, [fieldName], batchSize) as writer:
+        for f in layer.getFeatures(QgsFeatureRequest().setNoAttributes()):
+            writer.write(f.id(), [f.geometry().area() / divisor])
+
+
+def writeAccounts(layer, openingField, closingField, closingAreas, openingAreas=None):
+    # Closing code, opening and closing areas in km2 and their difference for each class of the layer
+    # closingField is the QgsField of the closing code, None to leave it out
+    # Opening areas are the feature areas unless given, classes without a closing area get NULL values
+    newFields = [QgsField('area1_km2', QVariant.Double),
+                 QgsField('area2_km2', QVariant.Double),
+                 QgsField('AbsDiff', QVariant.Double),
+                 QgsField('RelDiff', QVariant.Double)]
+    if closingField is not None:
+        newFields.insert(0, closingField)
+
+    if layer.dataProvider().capabilities() & QgsVectorDataProvider.AddAttributes:
+        layer.dataProvider().addAttributes(newFields)
+        layer.updateFields()
+
+    request = QgsFeatureRequest()
+    request.setSubsetOfAttributes([openingField], layer.fields())
+    if openingAreas is not None:
+        request.setFlags(QgsFeatureRequest.NoGeometry)
+
+    with AttributeWriter(layer, [field.name() for field in newFields]) as writer:
+        for f in layer.getFeatures(request):
+            lcOpening = f[openingField]
+            if openingAreas is not None:
+                area1 = openingAreas[lcOpening]
+            else:
+                area1 = f.geometry().area() / 1000000
+
+            if lcOpening in closingAreas:
+                area2 = closingAreas[lcOpening]
+                absDiff = area2 - area1
+                relDiff = (absDiff / area1) * 100.0
+                values = [area1, area2, absDiff, relDiff]
+                closingCode = lcOpening
+            else:
+                values = [area1, None, None, None]
+                closingCode = None
+
+            if closingField is not None:
+                values.insert(0, closingCode)
+
+            writer.write(f.id(), values)
+
+
+def sortedClasses(classes):
+    # Class codes in a fixed order whatever the order of the features, NULL last
+    # Codes of mixed types are ordered as text
+    known = [code for code in classes if code is not None and code != NULL]
+    missing = [code for code in classes if code is None or code == NULL]
+    try:
+        known.sort()
+    except TypeError:
+        known.sort(key=str)
+
+    return known + missing
+
+
+def writeTransitionCSV(path, pairAreas, names):
+    # Transition matrix CSV from the area of each (opening, closing) pair of codes
+    # Rows and columns are named with names, in the order of sortedClasses
+    openValues = [pair[0] for pair in pairAreas]
+    closeValues = [pair[1] for pair in pairAreas]
+    areas = list(pairAreas.values())
+
+    # Both axes use the same codes
+    codes, classes = factorize(openValues + closeValues)
+    numPairs = len(openValues)
+    matrix = transitionMatrix(codes[:numPairs], codes[numPairs:], areas, len(classes))
+
+    # Rows and columns in the same order for every method, not in the order pieces were read
+    position = {code: k for k, code in enumerate(classes)}
+    classes = sortedClasses(classes)
+    order = [position[code] for code in classes]
+    matrix = matrix[np.ix_(order, order)]
+
+    # No change between years is left blank, as are pairs without any area
+    np.fill_diagonal(matrix, 0)
+
+    namesHeader = ['Change from opening yr (column) to closing yr (row)'] + [names.get(code) for code in classes]
+    outCSV = [namesHeader]
+    for code, row in zip(classes, matrix.tolist()):
+        outCSV.append([names.get(code)] + ['' if area == 0 else area for area in row])
+
+    with open(path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file, delimiter=',')
+        writer.writerows(outCSV)
+
+
+def areaCalculator(crs, context):
+    # Areas on the ellipsoid for geographic coordinates, planar areas otherwise
+    da = QgsDistanceArea()
+    da.setSourceCrs(crs, context.transformContext())
+    if crs.isGeographic():
+        da.setEllipsoid(context.ellipsoid() or 'WGS84')
+
+    return da
+
+
+def rangeAreas(layer, idField, speciesIDs, context, feedback=None):
+    # Area in km2 of the union of all the features of each species in the layer
+    # Overlapping features, such as seasonal or presence polygons of one species, count once
+    da = areaCalculator(layer.crs(), context)
+    areas = dict.fromkeys(speciesIDs, 0.0)
+
+    # Find the features of each species first, then read only their geometries, one species at a time
+    speciesFids = {}
+    for f in layer.getFeatures(attributeRequest(layer, [idField])):
+        if f[idField] in areas:
+            speciesFids.setdefault(f[idField], []).append(f.id())
+
+    for speciesID, fids in speciesFids.items():
+        if feedback is not None and feedback.isCanceled():
+            break
+
+        request = QgsFeatureRequest().setFilterFids(fids).setNoAttributes()
+        request.setInvalidGeometryCheck(QgsFeatureRequest.GeometryNoCheck)
+        geometries = [f.geometry() for f in layer.getFeatures(request) if f.hasGeometry()]
+
+        if len(geometries) == 1:
+            rangeGeom = geometries[0]
+        else:
+            rangeGeom = QgsGeometry.unaryUnion(geometries)
+            if rangeGeom.isNull():
+                # Invalid features stop the union, repaired copies do not
+                rangeGeom = QgsGeometry.unaryUnion([geom.makeValid() for geom in geometries])
+
+        areas[speciesID] = da.measureArea(rangeGeom) / 1000000
+
+    return areas
+
+
+def rowAreas(grid, crs, context):
+    # Area in km2 of a pixel in each row of a RasterGrid, measured as rangeAreas does
+    da = areaCalculator(crs, context)
+    areas = np.zeros(grid.height)
+    for row in range(grid.height):
+        top = grid.originY - row * grid.res
+        rect = QgsRectangle(grid.originX, top - grid.res, grid.originX + grid.res, top)
+        areas[row] = da.measureArea(QgsGeometry.fromRect(rect)) / 1000000
+
+    return areas
+
+
+def sourceStamp(layer):
+    # Source, size and extent of a layer, with the size and time of its file, to tell changed inputs
+    parts = QgsProviderRegistry.instance().decodeUri(layer.providerType(), layer.source())
+
+    return [layer.source(), layer.featureCount(), layer.extent().toString(), fileStamp(parts.get('path', ''))]
+
+
+def speciesKeys(layer, idField, speciesIDs, cache, groupField=None, feedback=None):
+    # Cache key of each species, from all its features in the layer and their group in groupField
+    # Keys are kept in the cache folder for the layer as it is, so later runs only hash the species they add
+    sourceKey = fingerprint(sourceStamp(layer) + [idField, groupField])
+    known = cache.readKeys(sourceKey)
+
+    keys = {}
+    missing = set()
+    for speciesID in speciesIDs:
+        if str(speciesID) in known:
+            keys[speciesID] = known[str(speciesID)]
+        else:
+            missing.add(speciesID)
+
+    if len(missing) == 0:
+        return keys
+
+    # Find the features of each species first, then read only their geometries, one species at a time
+    speciesFids = {}
+    for f in layer.getFeatures(attributeRequest(layer, [idField])):
+        if f[idField] in missing:
+            speciesFids.setdefault(f[idField], []).append(f.id())
+
+    for speciesID, fids in speciesFids.items():
+        if feedback is not None and feedback.isCanceled():
+            break
+
+        request = QgsFeatureRequest().setFilterFids(fids)
+        request.setSubsetOfAttributes([groupField] if groupField else [], layer.fields())
+        request.setInvalidGeometryCheck(QgsFeatureRequest.GeometryNoCheck)
+
+        features = []
+        for f in layer.getFeatures(request):
+            wkb = bytes(f.geometry().asWkb()) if f.hasGeometry() else b''
+            if groupField:
+                group = '' if f[groupField] == NULL else str(f[groupField])
+                wkb = group.encode('utf-8') + b'\0' + wkb
+            features.append(wkb)
+
+        keys[speciesID] = cache.speciesKey(speciesID, features)
+        known[str(speciesID)] = keys[speciesID]
+
+    cache.writeKeys(sourceKey, known)
+
+    return keys
+
+
+def pythonExecutable():
+    # Inside QGIS sys.executable is the QGIS application, not the interpreter
+    # Child processes have to be started with the interpreter that ships with it
+    if os.path.basename(sys.executable).lower().startswith('python'):
+        return sys.executable
+
+    if sys.platform == 'win32':
+        candidates = [os.path.join(sys.exec_prefix, 'pythonw.exe'),
+                      os.path.join(sys.exec_prefix, 'python.exe')]
+    else:
+        candidates = [os.path.join(sys.exec_prefix, 'bin', 'python3'),
+                      os.path.join(sys.exec_prefix, 'bin', 'python')]
+
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+
+    return sys.executable
+
+
+def processPool(workers):
+    # Workers are spawned so they never inherit QGIS state from the parent
+    mpContext = multiprocessing.get_context('spawn')
+    mpContext.set_executable(pythonExecutable())
+
+    return ProcessPoolExecutor(max_workers=workers, mp_context=mpContext)
+
+
+def chunkList(items, size):
+    # Split a list into consecutive chunks of at most size items
+    size = max(1, int(size))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def runChunks(pool, function, chunks, *args, **kwargs):
+    # Results of function(*args, chunk, **kwargs) for each chunk
+    # With a pool they come back as they complete, without one they are computed here in order
+    # Chunks not started yet are cancelled when the caller stops early
+    if pool is None:
+        for chunk in chunks:
+            yield function(*args, chunk, **kwargs)
+        return
+
+    futures = [pool.submit(function, *args, chunk, **kwargs) for chunk in chunks]
+    try:
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def ogrSource(layer, crs, store, name, context, feedback):
+    # Worker processes read data with OGR, so they need a file in the CRS of the analysis
+    # Layers that are not plain OGR files in that CRS are exported to the scratch GeoPackage
+    if layer.providerType() == 'ogr' and layer.subsetString() == '' and layer.crs() == crs:
+        parts = QgsProviderRegistry.instance().decodeUri('ogr', layer.source())
+        path = parts.get('path', '')
+
+        if path != '' and os.path.exists(path):
+            if parts.get('layerName'):
+                return path, parts['layerName']
+            return path, parts.get('layerId', 0)
+
+    alg_params = {
+        'INPUT': layer,
+        'TARGET_CRS': crs,
+        'OUTPUT': store.destination(name, layer.featureCount(), onDisk=True)
+    }
+
+    processing.run(
+        'native:reprojectlayer',
+        alg_params, context=context,
+        feedback=feedback, is_child_algorithm=True
+    )
+
+    return store.gpkg, name
@@ -0,0 +1,125 @@
+'''
+Nature Braid for SEEA
+
+Sparse species x pixel presence matrix
+
+The pixels of each species are stored as sorted linear pixel indices in
+one array, species after species (compressed sparse rows keyed by id_no).
+Richness of any subset of species is then a count of pixel indices, with
+no rasterization needed.
+'''
+
+import numpy as np
+
+from NB_rasterise import RasterGrid
+
+
+class PresenceMatrix:
+
+    def __init__(self, speciesIDs, indptr, indices, grid):
+        # Pixels of speciesIDs[k] are indices[indptr[k]:indptr[k + 1]]
+        self.speciesIDs = np.asarray(speciesIDs)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices)
+        self.grid = grid
+
+    @classmethod
+    def fromParts(cls, parts, grid):
+        # parts: dictionary of speciesID -> list of arrays of linear pixel indices
+        speciesIDs = sorted(parts)
+        counts = [sum(len(pixels) for pixels in parts[speciesID]) for speciesID in speciesIDs]
+
+        indptr = np.zeros(len(speciesIDs) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+
+        indices = np.empty(int(indptr[-1]), dtype=pixelType(grid))
+        for k, speciesID in enumerate(speciesIDs):
+            pixels = indices[indptr[k]:indptr[k + 1]]
+            start = 0
+            for part in parts[speciesID]:
+                pixels[start:start + len(part)] = part
+                start += len(part)
+            pixels.sort()
+
+        return cls(speciesIDs, indptr, indices, grid)
+
+    def save(self, path):
+        np.savez_compressed(path,
+                            speciesIDs=self.speciesIDs,
+                            indptr=self.indptr,
+                            indices=self.indices,
+                            geoTransform=np.array(self.grid.geoTransform()),
+                            shape=np.array([self.grid.height, self.grid.width]),
+                            crsWkt=np.array(self.grid.crsWkt))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            geoTransform = data['geoTransform']
+            height, width = (int(v) for v in data['shape'])
+            grid = RasterGrid(float(geoTransform[0]), float(geoTransform[3]), float(geoTransform[1]),
+                              width, height, str(data['crsWkt']))
+
+            return cls(data['speciesIDs'], data['indptr'], data['indices'], grid)
+
+    def find(self, speciesIDs):
+        # Rows of the given species, species that are not in the matrix are left out
+        wanted = np.asarray(list(speciesIDs), dtype=self.speciesIDs.dtype)
+        return np.flatnonzero(np.isin(self.speciesIDs, wanted))
+
+    def pixels(self, speciesID):
+        # Linear pixel indices of one species
+        rows = self.find([speciesID])
+        if len(rows) == 0:
+            return self.indices[:0]
+
+        return self.indices[self.indptr[rows[0]]:self.indptr[rows[0] + 1]]
+
+    def subsetRichness(self, speciesIDs=None):
+        # Number of the given species in each pixel, all species by default
+        if speciesIDs is None:
+            selected = self.indices
+        else:
+            rows = self.find(speciesIDs)
+            selected = np.concatenate([self.indices[self.indptr[k]:self.indptr[k + 1]] for k in rows] + [self.indices[:0]])
+
+        counts = np.bincount(selected.astype(np.int64), minlength=self.grid.width * self.grid.height)
+
+        return counts.reshape(self.grid.height, self.grid.width)
+
+
+def pixelType(grid):
+    # Smallest unsigned type for the linear pixel indices of the grid
+    if grid.width * grid.height <= np.iinfo(np.uint32).max:
+        return np.uint32
+
+    return np.uint64
+
+
+def tilePixels(pixels, window, grid):
+    # Linear indices in the whole grid of linear indices in the tile window (xOff, yOff, width, height)
+    xOff, yOff, width, height = window
+    rows, cols = np.divmod(pixels.astype(np.int64), width)
+
+    return ((rows + yOff) * grid.width + cols + xOff).astype(pixelType(grid))
+
+
+def packParts(parts):
+    # Arrays holding a dictionary of speciesID -> list of arrays of linear pixel indices
+    speciesIDs = sorted(parts)
+    pixels = [np.concatenate(parts[speciesID]) for speciesID in speciesIDs]
+
+    indptr = np.zeros(len(speciesIDs) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(speciesPixels) for speciesPixels in pixels])
+
+    return {'presenceIDs': np.array(speciesIDs),
+            'presenceIndptr': indptr,
+            'presenceIndices': np.concatenate(pixels) if len(pixels) > 0 else np.zeros(0, dtype=np.uint32)}
+
+
+def unpackParts(arrays):
+    # Dictionary of speciesID -> list of arrays of linear pixel indices, from packParts
+    indptr = arrays['presenceIndptr']
+    indices = arrays['presenceIndices']
+
+    return {speciesID.item(): [indices[indptr[k]:indptr[k + 1]]] for k, speciesID in enumerate(arrays['presenceIDs'])}
@@ -0,0 +1,489 @@
+'''
+Nature Braid for SEEA
+
+Rasterisation engine for species richness
+
+Species ranges are burnt into a reusable in-memory raster and added into
+a richness array, so no raster is written per species. Only GDAL/OGR and
+NumPy are used, so the same code runs in worker processes.
+'''
+
+from osgeo import gdal, ogr, osr
+import math
+import numpy as np
+
+
+class RasterGrid:
+    # Grid of square pixels, origin at the top left corner
+
+    def __init__(self, originX, originY, res, width, height, crsWkt):
+        self.originX = originX
+        self.originY = originY
+        self.res = res
+        self.width = width
+        self.height = height
+        self.crsWkt = crsWkt
+
+    @classmethod
+    def fromExtent(cls, xMin, yMin, xMax, yMax, res, crsWkt):
+        # Same pixel layout as gdal_rasterize with -te and -tr
+        width = max(1, int((xMax - xMin) / res + 0.5))
+        height = max(1, int((yMax - yMin) / res + 0.5))
+
+        return cls(xMin, yMax, res, width, height, crsWkt)
+
+    @classmethod
+    def snapped(cls, xMin, yMin, xMax, yMax, res, crsWkt):
+        # Grid covering the extent with its pixel edges on multiples of res
+        col0 = math.floor(xMin / res)
+        col1 = math.ceil(xMax / res)
+        row0 = math.floor(-yMax / res)
+        row1 = math.ceil(-yMin / res)
+
+        return cls(col0 * res, -row0 * res, res, max(1, col1 - col0), max(1, row1 - row0), crsWkt)
+
+    def geoTransform(self):
+        return (self.originX, self.res, 0.0, self.originY, 0.0, -self.res)
+
+    def extent(self):
+        # (xMin, yMin, xMax, yMax)
+        return (self.originX,
+                self.originY - self.height * self.res,
+                self.originX + self.width * self.res,
+                self.originY)
+
+    def window(self, xOff, yOff, width, height):
+        # Part of the grid starting at pixel (xOff, yOff)
+        return RasterGrid(self.originX + xOff * self.res,
+                          self.originY - yOff * self.res,
+                          self.res, width, height, self.crsWkt)
+
+    def coarsened(self, factor):
+        # Grid of cells of factor x factor pixels with the same origin, partial cells included
+        return RasterGrid(self.originX, self.originY, self.res * factor,
+                          -(-self.width // factor), -(-self.height // factor), self.crsWkt)
+
+    def tiles(self, tileSize):
+        # Windows of at most tileSize x tileSize pixels covering the grid, row by row
+        windows = []
+        for yOff in range(0, self.height, tileSize):
+            for xOff in range(0, self.width, tileSize):
+                windows.append((xOff, yOff,
+                                min(tileSize, self.width - xOff),
+                                min(tileSize, self.height - yOff)))
+
+        return windows
+
+
+class SpeciesBurner:
+    # Burns geometries into one in-memory byte raster and reads it back into the same buffer
+
+    def __init__(self, grid):
+        self.grid = grid
+        self.srs = osr.SpatialReference()
+        self.srs.ImportFromWkt(grid.crsWkt)
+        self.srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+        self.raster = gdal.GetDriverByName('MEM').Create('', grid.width, grid.height, 1, gdal.GDT_Byte)
+        self.raster.SetGeoTransform(grid.geoTransform())
+        self.raster.SetProjection(grid.crsWkt)
+        self.band = self.raster.GetRasterBand(1)
+        self.buffer = np.zeros((grid.height, grid.width), dtype=np.uint8)
+
+        self.vectorDriver = ogr.GetDriverByName('Memory') or ogr.GetDriverByName('MEM')
+
+    def burn(self, geometries):
+        # Presence (0/1) of the union of the geometries, pixel centres inside count
+        # The returned buffer is overwritten by the next call
+        self.band.Fill(0)
+
+        ds = self.vectorDriver.CreateDataSource('burn')
+        lyr = ds.CreateLayer('burn', self.srs, ogr.wkbUnknown)
+        defn = lyr.GetLayerDefn()
+
+        for geom in geometries:
+            if not isinstance(geom, ogr.Geometry):
+                geom = ogr.CreateGeometryFromWkb(bytes(geom))
+
+            feat = ogr.Feature(defn)
+            feat.SetGeometry(geom)
+            lyr.CreateFeature(feat)
+
+        gdal.RasterizeLayer(self.raster, [1], lyr, burn_values=[1])
+        self.band.ReadAsArray(buf_obj=self.buffer)
+
+        return self.buffer
+
+
+class CoverageBurner:
+    # Exact fraction of each pixel covered by the union of polygons
+    # With a threshold it gives presence (0/1) where the fraction reaches the threshold
+    # Overlapping polygons, such as seasonal ranges of one species, are merged before the edges are taken
+
+    def __init__(self, grid, threshold=0):
+        self.grid = grid
+        self.threshold = threshold
+        self.coverage = np.zeros((grid.height, grid.width), dtype=np.float32)
+
+        if threshold > 0:
+            self.buffer = np.zeros((grid.height, grid.width), dtype=np.uint8)
+        else:
+            self.buffer = self.coverage
+
+    def burn(self, geometries):
+        # The returned buffer is overwritten by the next call
+        edges = []
+        for ring, exterior in polygonRings(unionPolygons(geometries)):
+            edges.append(ringEdges(ring, exterior, self.grid))
+
+        if len(edges) == 0:
+            self.coverage.fill(0)
+        else:
+            coverageFraction(np.concatenate(edges), self.grid.width, self.grid.height, self.coverage)
+
+        if self.threshold > 0:
+            np.greater_equal(self.coverage, self.threshold, out=self.buffer.view(np.bool_))
+
+        return self.buffer
+
+
+def polygonParts(geom):
+    # Polygons of a geometry, curves made linear
+    if geom.HasCurveGeometry():
+        geom = geom.GetLinearGeometry()
+
+    geomType = ogr.GT_Flatten(geom.GetGeometryType())
+    if geomType == ogr.wkbPolygon:
+        yield geom
+
+    elif geomType in (ogr.wkbMultiPolygon, ogr.wkbGeometryCollection):
+        for i in range(geom.GetGeometryCount()):
+            yield from polygonParts(geom.GetGeometryRef(i))
+
+
+def unionPolygons(geometries):
+    # Union of the polygons of the geometries (OGR geometries or WKB) as one geometry
+    # Overlaps count once, so ring edges of the result cover each point at most once
+    parts = ogr.Geometry(ogr.wkbMultiPolygon)
+    for geom in geometries:
+        if not isinstance(geom, ogr.Geometry):
+            geom = ogr.CreateGeometryFromWkb(bytes(geom))
+
+        for polygon in polygonParts(geom):
+            parts.AddGeometry(polygon)
+
+    if parts.GetGeometryCount() <= 1:
+        return parts
+
+    union = parts.UnionCascaded()
+    if union is not None:
+        return union
+
+    # Invalid polygons stop the union, a zero buffer repairs most of them
+    repaired = ogr.Geometry(ogr.wkbMultiPolygon)
+    for i in range(parts.GetGeometryCount()):
+        polygon = parts.GetGeometryRef(i)
+        if not polygon.IsValid():
+            polygon = polygon.Buffer(0)
+        for fixed in polygonParts(polygon):
+            repaired.AddGeometry(fixed)
+
+    # Polygons that cannot be merged at all are burnt as they are, overlaps then add up to at most 1
+    union = repaired.UnionCascaded()
+    if union is None:
+        return repaired
+
+    return union
+
+
+def polygonRings(geom):
+    # Rings of all the polygons of a geometry, with True for exterior rings
+    if geom.HasCurveGeometry():
+        geom = geom.GetLinearGeometry()
+
+    geomType = ogr.GT_Flatten(geom.GetGeometryType())
+    if geomType == ogr.wkbPolygon:
+        for i in range(geom.GetGeometryCount()):
+            yield geom.GetGeometryRef(i), i == 0
+
+    elif geomType in (ogr.wkbMultiPolygon, ogr.wkbGeometryCollection):
+        for i in range(geom.GetGeometryCount()):
+            yield from polygonRings(geom.GetGeometryRef(i))
+
+
+def ringEdges(ring, exterior, grid):
+    # Edges (x0, y0, x1, y1, sign) of a ring in pixel coordinates, rows going down
+    # The sign makes the area of exterior rings count up and the area of holes count down
+    points = np.array(ring.GetPoints(), dtype=np.float64).reshape(-1, ring.GetCoordinateDimension())
+    if len(points) < 3:
+        return np.zeros((0, 5))
+
+    x = (points[:, 0] - grid.originX) / grid.res
+    y = (grid.originY - points[:, 1]) / grid.res
+    if x[0] != x[-1] or y[0] != y[-1]:
+        x = np.r_[x, x[0]]
+        y = np.r_[y, y[0]]
+
+    # Clockwise rings on screen have a positive area here and come out negative from coverageFraction
+    area = np.sum(x[:-1] * y[1:] - x[1:] * y[:-1])
+    sign = -np.sign(area) if exterior else np.sign(area)
+
+    return np.column_stack([x[:-1], y[:-1], x[1:], y[1:], np.full(len(x) - 1, sign)])
+
+
+def coverageFraction(edges, width, height, out):
+    '''
+    Fraction of each pixel covered by the polygons with the given edges
+
+    Edges are split where they cross pixel edges inside the grid, so each
+    piece lies within one cell, or left or right of the grid. A piece adds
+    its signed height times the part of its cell to the right of it to that
+    cell, and its full height to the cells further right. A running sum
+    along each row then gives the covered area of each pixel exactly. Only
+    NumPy operations are used, with no loop over edges or pixels.
+    '''
+    x0, y0, x1, y1, sign = edges.T
+
+    # Edges outside the rows of the grid or along a row do not count
+    keep = (y0 != y1) & (np.maximum(y0, y1) > 0) & (np.minimum(y0, y1) < height)
+    x0, y0, x1, y1, sign = x0[keep], y0[keep], x1[keep], y1[keep], sign[keep]
+    dx = x1 - x0
+    dy = y1 - y0
+    edge = np.arange(len(x0))
+
+    def crossings(lo, hi, size):
+        # Integer lines strictly between lo and hi, limited to 0..size
+        first = np.maximum(np.floor(lo) + 1, 0)
+        last = np.minimum(np.ceil(hi) - 1, size)
+        counts = np.maximum(last - first + 1, 0).astype(np.int64)
+        starts = np.repeat(np.cumsum(counts) - counts, counts)
+        lines = np.repeat(first, counts) + (np.arange(counts.sum()) - starts)
+        return np.repeat(edge, counts), lines
+
+    rowEdge, rows = crossings(np.minimum(y0, y1), np.maximum(y0, y1), height)
+    colEdge, cols = crossings(np.minimum(x0, x1), np.maximum(x0, x1), width)
+
+    # Position along each edge of its ends and of its crossings, in order
+    pieceEdge = np.concatenate([edge, edge, rowEdge, colEdge])
+    t = np.concatenate([np.zeros(len(edge)), np.ones(len(edge)),
+                        (rows - y0[rowEdge]) / dy[rowEdge],
+                        (cols - x0[colEdge]) / np.where(dx[colEdge] == 0, 1, dx[colEdge])])
+
+    order = np.lexsort((t, pieceEdge))
+    pieceEdge = pieceEdge[order]
+    t = t[order]
+
+    # Consecutive positions on the same edge make a piece
+    same = pieceEdge[1:] == pieceEdge[:-1]
+    e = pieceEdge[:-1][same]
+    tA = t[:-1][same]
+    tB = t[1:][same]
+
+    tMid = (tA + tB) / 2
+    xMid = x0[e] + tMid * dx[e]
+    yMid = y0[e] + tMid * dy[e]
+    pieceHeight = (tB - tA) * dy[e] * sign[e]
+
+    row = np.floor(yMid).astype(np.int64)
+    inRows = (row >= 0) & (row < height) & (pieceHeight != 0)
+    row = row[inRows]
+    xMid = xMid[inRows]
+    pieceHeight = pieceHeight[inRows]
+
+    # Pieces left of the grid count for the whole row, pieces right of it do not count
+    col = np.clip(np.floor(xMid), -1, width).astype(np.int64)
+    right = xMid - col
+
+    stride = width + 3
+    index = row * stride + col + 1
+    acc = np.bincount(index, weights=pieceHeight * (1 - right), minlength=height * stride)
+    acc += np.bincount(index + 1, weights=pieceHeight * right, minlength=height * stride)
+
+    coverage = np.cumsum(acc.reshape(height, stride), axis=1)[:, 1:width + 1]
+    np.clip(coverage, 0, 1, out=out)
+
+    return out
+
+
+def poolPresence(presence, factors):
+    # Presence in cells of factor x factor pixels for each factor, a cell has presence if any of its pixels has
+    # Cells at the right and bottom edges can have fewer pixels
+    # Factors that are multiples of a smaller one are pooled from that level
+    levels = {}
+    for factor in sorted(factors):
+        base = presence
+        step = factor
+        for smaller in sorted(levels, reverse=True):
+            if factor % smaller == 0:
+                base = levels[smaller]
+                step = factor // smaller
+                break
+
+        height, width = base.shape
+        paddedHeight = -(-height // step) * step
+        paddedWidth = -(-width // step) * step
+        if (paddedHeight, paddedWidth) != (height, width):
+            padded = np.zeros((paddedHeight, paddedWidth), dtype=base.dtype)
+            padded[:height, :width] = base
+            base = padded
+
+        levels[factor] = base.reshape(paddedHeight // step, step, paddedWidth // step, step).max(axis=(1, 3))
+
+    return levels
+
+
+def tileSize(budgetMB, bytesPerPixel, blockSize=256):
+    # Side of the largest square tile that fits the memory budget, in whole blocks
+    pixels = budgetMB * 1024 * 1024 / bytesPerPixel
+    blocks = int(pixels ** 0.5) // blockSize
+
+    return max(1, blocks) * blockSize
+
+
+def speciesIndex(lyr, idField, extent=None):
+    # Feature IDs of each species, species sorted by ID
+    # With an extent (xMin, yMin, xMax, yMax) only features whose bounding box touches it are read
+    ignored = ['OGR_STYLE'] + [
+        lyr.GetLayerDefn().GetFieldDefn(i).GetName()
+        for i in range(lyr.GetLayerDefn().GetFieldCount())
+        if lyr.GetLayerDefn().GetFieldDefn(i).GetName() != idField]
+
+    if extent is None:
+        ignored.append('OGR_GEOMETRY')
+        lyr.SetSpatialFilter(None)
+    else:
+        lyr.SetSpatialFilterRect(*extent)
+
+    lyr.SetIgnoredFields(ignored)
+    lyr.ResetReading()
+
+    fids = {}
+    for feat in lyr:
+        speciesID = feat.GetField(idField)
+        if speciesID is None:
+            continue
+        fids.setdefault(speciesID, []).append(feat.GetFID())
+
+    lyr.SetIgnoredFields([])
+    lyr.SetSpatialFilter(None)
+    lyr.ResetReading()
+
+    return [(speciesID, fids[speciesID]) for speciesID in sorted(fids)]
+
+
+def readGeometries(lyr, fids):
+    # Geometries of the given features
+    geometries = []
+    for fid in fids:
+        feat = lyr.GetFeature(fid)
+        if feat is None:
+            continue
+
+        geom = feat.GetGeometryRef()
+        if geom is not None and not geom.IsEmpty():
+            geometries.append(geom.Clone())
+
+    return geometries
+
+
+def readGroupedGeometries(lyr, fids, fieldName):
+    # Geometries of the given features by the value of a field, as text
+    # Features without a value are under None
+    fieldIdx = lyr.GetLayerDefn().GetFieldIndex(fieldName)
+
+    groups = {}
+    for fid in fids:
+        feat = lyr.GetFeature(fid)
+        if feat is None:
+            continue
+
+        geom = feat.GetGeometryRef()
+        if geom is None or geom.IsEmpty():
+            continue
+
+        if feat.IsFieldSetAndNotNull(fieldIdx):
+            group = str(feat.GetField(fieldIdx))
+        else:
+            group = None
+
+        groups.setdefault(group, []).append(geom.Clone())
+
+    return groups
+
+
+def countType(maxCount):
+    # Smallest GDAL and NumPy unsigned types for counts up to maxCount, 0 is left for NoData
+    if maxCount <= np.iinfo(np.uint8).max:
+        return gdal.GDT_Byte, np.uint8
+    if maxCount <= np.iinfo(np.uint16).max:
+        return gdal.GDT_UInt16, np.uint16
+
+    return gdal.GDT_UInt32, np.uint32
+
+
+class RasterWriter:
+    # Tiled, compressed GeoTIFF written window by window, so the whole raster is never held in memory
+
+    def __init__(self, path, grid, nodata, dataType=gdal.GDT_Float32, blockSize=256, bands=1, compress='DEFLATE'):
+        self.blockSize = blockSize
+        self.compress = compress
+        self.predictor = '3' if dataType in (gdal.GDT_Float32, gdal.GDT_Float64) else '2'
+
+        options = ['TILED=YES',
+                   'BLOCKXSIZE=' + str(blockSize),
+                   'BLOCKYSIZE=' + str(blockSize),
+                   'BIGTIFF=IF_SAFER']
+
+        if compress:
+            options += ['COMPRESS=' + compress, 'PREDICTOR=' + self.predictor]
+
+        if bands > 1:
+            options.append('INTERLEAVE=BAND')
+
+        self.ds = gdal.GetDriverByName('GTiff').Create(path, grid.width, grid.height, bands, dataType, options)
+        if self.ds is None:
+            raise RuntimeError('Could not create ' + str(path))
+
+        self.ds.SetGeoTransform(grid.geoTransform())
+        self.ds.SetProjection(grid.crsWkt)
+        self.bands = [self.ds.GetRasterBand(i + 1) for i in range(bands)]
+        for band in self.bands:
+            band.SetNoDataValue(nodata)
+
+    def describe(self, band, description):
+        # Band numbers start at 1
+        self.bands[band - 1].SetDescription(description)
+
+    def write(self, array, xOff, yOff, band=1):
+        self.bands[band - 1].WriteArray(array, xOff, yOff)
+
+    def buildOverviews(self, resampling='NEAREST'):
+        # Internal overviews halving the size down to about one block, compressed as the raster
+        levels = []
+        factor = 2
+        while max(self.ds.RasterXSize, self.ds.RasterYSize) / factor >= self.blockSize:
+            levels.append(factor)
+            factor *= 2
+
+        if len(levels) == 0:
+            return
+
+        self.ds.FlushCache()
+
+        # Overview creation options are only read from the configuration, restored afterwards
+        config = {'COMPRESS_OVERVIEW': self.compress or None,
+                  'PREDICTOR_OVERVIEW': self.predictor if self.compress else None}
+        previous = {key: gdal.GetConfigOption(key) for key in config}
+        try:
+            for key, value in config.items():
+                gdal.SetConfigOption(key, value)
+            self.ds.BuildOverviews(resampling, levels)
+        finally:
+            for key, value in previous.items():
+                gdal.SetConfigOption(key, value)
+
+    def close(self):
+        for band in self.bands:
+            band.FlushCache()
+        self.bands = []
+        self.ds = None
@@ -0,0 +1,272 @@
+'''
+Nature Braid for SEEA
+
+Functions run in worker processes
+
+Workers only use OGR, so they can run without a QGIS application.
+Data is always opened read-only.
+'''
+
+from osgeo import ogr
+import numpy as np
+
+from NB_rasterise import SpeciesBurner, CoverageBurner, countType, poolPresence, readGeometries, readGroupedGeometries
+
+
+def openLayer(dataSource, layerName):
+    # Open a layer read-only by name or by index
+    ds = ogr.Open(dataSource, 0)
+    if ds is None:
+        raise RuntimeError('Could not open ' + str(dataSource))
+
+    if isinstance(layerName, str):
+        lyr = ds.GetLayerByName(layerName)
+    else:
+        lyr = ds.GetLayer(int(layerName or 0))
+
+    if lyr is None:
+        raise RuntimeError('Could not open layer ' + str(layerName) + ' in ' + str(dataSource))
+
+    # Keep the data source alive for as long as the layer
+    return ds, lyr
+
+
+def aggregateUnits(dataSource, layerName, fieldName, units):
+    # units: list of (featureID, WKB geometry) in the CRS of the data
+    # Returns (featureID, [(class, area), ...]) for each unit, in the order given, and the number of
+    # pieces left out because their geometries could not be repaired or intersected
+    # Invalid geometries are repaired with validGeometry, NULL classes are None
+    ds, lyr = openLayer(dataSource, layerName)
+    fieldIdx = lyr.GetLayerDefn().GetFieldIndex(fieldName)
+
+    results = []
+    skipped = 0
+    for featureID, wkb in units:
+        unitGeom = validGeometry(ogr.CreateGeometryFromWkb(bytes(wkb)))
+        if unitGeom is None:
+            results.append((featureID, []))
+            skipped += 1
+            continue
+
+        # The spatial filter uses the index of the data source and tests intersection
+        lyr.SetSpatialFilter(unitGeom)
+        lyr.ResetReading()
+
+        pieces = []
+        for feat in lyr:
+            if feat.GetGeometryRef() is None:
+                continue
+
+            geom = validGeometry(feat.GetGeometryRef())
+            clipped = unitGeom.Intersection(geom) if geom is not None else None
+            if clipped is None:
+                skipped += 1
+                continue
+
+            area = clipped.GetArea()
+            if area <= 0:
+                continue
+
+            pieces.append((feat.GetField(fieldIdx), area))
+
+        results.append((featureID, pieces))
+
+    lyr.SetSpatialFilter(None)
+    del lyr
+    del ds
+
+    return results, skipped
+
+
+def rasteriseSpecies(dataSource, layerName, grid, cache, species, presence=False, groupField=None, groups=None,
+                     rangeAreas=None, pixelAreas=None, coverage=False, threshold=0,
+                     factors=None, mask=None):
+    # species: list of (speciesID, [feature IDs], cache key of the species or None)
+    # cache: RangeCache to read and store the presence of each species under its key, or None
+    # Returns the partial sums of these species on the grid, their number and their IDs
+    # With presence, also the linear indices of the pixels of each species on the grid
+    # With groupField, also the partial sums of each group in groups (values of the field as text)
+    # With rangeAreas (speciesID: km2) and pixelAreas (km2 of a pixel in each row of the grid),
+    # also the partial sums of range-size rarity, 1 / range area, and weighted endemism,
+    # the share of the range in the pixel
+    # With coverage, each species adds the fraction of the pixel it covers, or with a threshold
+    # counts where that fraction reaches the threshold; fractions cannot be cached
+    # With factors, also the partial sums on coarser grids of factor x factor pixels, where a species
+    # counts once in a cell if it is in any of its pixels within the mask (0/1 array of the grid)
+    ds, lyr = openLayer(dataSource, layerName)
+
+    burnGrid = grid if cache is None else cache.blockGrid(grid)[0]
+    if coverage:
+        burner = CoverageBurner(burnGrid, threshold)
+    else:
+        burner = SpeciesBurner(burnGrid)
+
+    # Sums of fractions need floating point arrays, counts of the chunk need a type that holds them all
+    fractional = coverage and threshold <= 0
+    sumType = np.float32 if fractional else countType(len(species))[1]
+
+    def burnSpecies(key, geometries, group=None):
+        if cache is None:
+            return burner.burn(geometries)
+
+        # The ranges of a species in one group are cached under their own key
+        if group is not None:
+            key = cache.groupKey(key, group)
+        return cache.presence(key, grid, geometries, burner)
+
+    groupIndex = {group: k for k, group in enumerate(groups or [])}
+
+    richness = np.zeros((grid.height, grid.width), dtype=sumType)
+    groupRichness = np.zeros((len(groupIndex), grid.height, grid.width), dtype=sumType)
+    pixels = {}
+
+    pyramid = {}
+    for factor in factors or []:
+        pyramid[factor] = np.zeros((-(-grid.height // factor), -(-grid.width // factor)), dtype=sumType)
+
+    weighted = rangeAreas is not None
+    if weighted:
+        rarity = np.zeros((grid.height, grid.width))
+        endemism = np.zeros((grid.height, grid.width))
+        pixelAreas = np.asarray(pixelAreas, dtype=np.float64).reshape(-1, 1)
+
+    for speciesID, fids, key in species:
+        if groupField is None:
+            grouped = {}
+            geometries = readGeometries(lyr, fids)
+        else:
+            grouped = readGroupedGeometries(lyr, fids, groupField)
+            geometries = [geom for groupGeometries in grouped.values() for geom in groupGeometries]
+
+        if len(geometries) == 0:
+            continue
+
+        speciesPresence = burnSpecies(key, geometries)
+
+        richness += speciesPresence
+        if presence:
+            pixels[speciesID] = np.flatnonzero(speciesPresence).astype(np.uint32)
+
+        if len(pyramid) > 0:
+            for factor, level in poolPresence(np.bitwise_and(speciesPresence, mask), pyramid).items():
+                pyramid[factor] += level
+
+        # Species without a known range area only count in richness
+        rangeArea = rangeAreas.get(speciesID, 0) if weighted else 0
+        if rangeArea > 0 and fractional:
+            rarity += speciesPresence * (1 / rangeArea)
+            endemism += np.minimum(1, speciesPresence * (pixelAreas / rangeArea))
+        elif rangeArea > 0:
+            inRange = speciesPresence.view(np.bool_)
+            np.add(rarity, 1 / rangeArea, out=rarity, where=inRange)
+            np.add(endemism, np.minimum(1, pixelAreas / rangeArea), out=endemism, where=inRange)
+
+        # A species counts once in each group it has ranges in
+        # With a single group its presence is the one already burnt
+        for group, groupGeometries in grouped.items():
+            if group not in groupIndex:
+                continue
+
+            if len(grouped) == 1:
+                groupRichness[groupIndex[group]] += speciesPresence
+            else:
+                groupRichness[groupIndex[group]] += burnSpecies(key, groupGeometries, group)
+
+    del lyr
+    del ds
+
+    results = {'richness': richness, 'species': len(species), 'speciesIDs': [entry[0] for entry in species]}
+    if presence:
+        results['presence'] = pixels
+    if groupField is not None:
+        results['groups'] = groupRichness
+    if len(pyramid) > 0:
+        results['pyramid'] = pyramid
+    if weighted:
+        results['rarity'] = rarity
+        results['endemism'] = endemism
+
+    return results
+
+
+def validGeometry(geom):
+    # The geometry itself when valid, otherwise a repaired copy, None if it cannot be repaired
+    if geom is None or geom.IsValid():
+        return geom
+
+    try:
+        fixed = geom.MakeValid()
+    except AttributeError:
+        # GDAL before 3.0 has no MakeValid, a zero buffer repairs most self-intersections
+        fixed = geom.Buffer(0)
+
+    if fixed is None or not fixed.IsValid():
+        return None
+
+    return fixed
+
+
+def intersectTiles(openSource, openName, openField, nameField, closeSource, closeName, closeField, tiles):
+    # tiles: list of (xMin, yMin, xMax, yMax), the two layers in the same CRS
+    # Returns the area in km2 of each (opening, closing) pair inside the tiles, the name of each opening class,
+    # and the number of pieces left out because their geometries could not be repaired or intersected
+    # Opening polygons are cut at the tile edges, so pieces from neighbouring tiles add up to the whole overlay
+    openDs, openLyr = openLayer(openSource, openName)
+    closeDs, closeLyr = openLayer(closeSource, closeName)
+    openIdx = openLyr.GetLayerDefn().GetFieldIndex(openField)
+    nameIdx = openLyr.GetLayerDefn().GetFieldIndex(nameField) if nameField else -1
+    closeIdx = closeLyr.GetLayerDefn().GetFieldIndex(closeField)
+
+    pairAreas = {}
+    names = {}
+    skipped = 0
+    for xMin, yMin, xMax, yMax in tiles:
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in ((xMin, yMin), (xMax, yMin), (xMax, yMax), (xMin, yMax), (xMin, yMin)):
+            ring.AddPoint_2D(x, y)
+        tileGeom = ogr.Geometry(ogr.wkbPolygon)
+        tileGeom.AddGeometry(ring)
+
+        openLyr.SetSpatialFilterRect(xMin, yMin, xMax, yMax)
+        openLyr.ResetReading()
+        for openFeat in openLyr:
+            if openFeat.GetGeometryRef() is None:
+                continue
+
+            geom = validGeometry(openFeat.GetGeometryRef())
+            openPiece = tileGeom.Intersection(geom) if geom is not None else None
+            if openPiece is None:
+                skipped += 1
+                continue
+            if openPiece.GetArea() <= 0:
+                continue
+
+            lcOpening = openFeat.GetField(openIdx)
+            names.setdefault(lcOpening, openFeat.GetField(nameIdx) if nameIdx >= 0 else None)
+
+            # The spatial filter uses the index of the closing data source
+            closeLyr.SetSpatialFilter(openPiece)
+            closeLyr.ResetReading()
+            for closeFeat in closeLyr:
+                if closeFeat.GetGeometryRef() is None:
+                    continue
+
+                closeGeom = validGeometry(closeFeat.GetGeometryRef())
+                piece = openPiece.Intersection(closeGeom) if closeGeom is not None else None
+                if piece is None:
+                    skipped += 1
+                    continue
+
+                area = piece.GetArea()
+                if area <= 0:
+                    continue
+
+                pair = (lcOpening, closeFeat.GetField(closeIdx))
+                pairAreas[pair] = pairAreas.get(pair, 0.0) + area / 1000000
+
+    openLyr.SetSpatialFilter(None)
+    closeLyr.SetSpatialFilter(None)
+    del openLyr, closeLyr
+    del openDs, closeDs
+
+    return pairAreas, names, skipped